@@ -1,17 +1,163 @@
 import datetime
+import sys
+from bson import ObjectId
+from pymongo import UpdateMany, UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError
 from pymongo.mongo_client import MongoClient
 from tqdm import tqdm
 
 
+SYNC_STATE_ID = "printess_templates_sync"
+SYNC_BATCH_SIZE = 100
+# max time to wait for more changes before a partial batch is applied
+SYNC_MAX_AWAIT_MS = 1000
+REGISTER_BATCH_SIZE = 1000
+# registry entries without a project are taken over once they are older
+TOKEN_ORPHAN_SECONDS = 5 * 60
+
+
 def get_connection():
     return MongoClient("")
 
 
-def migrate():
-    collection_old = get_connection()["kleineprints_new"]["printess_templates"]
-    collection_new = get_connection()["kleineprints"][
-        "jep_tools__customer_project"
+def get_collections(connection):
+    collection_old = connection["kleineprints_new"]["printess_templates"]
+    collection_new = connection["kleineprints"]["jep_tools__customer_project"]
+    collection_token = connection["kleineprints"][
+        "jep_tools__customer_project_token"
     ]
+    collection_token.create_index("token", unique=True)
+    collection_new.create_index("template_id", sparse=True)
+    return collection_old, collection_new, collection_token
+
+
+def template_to_project(template, current_date):
+    created_at = template.get("created_at", current_date)
+    available_until = template.get(
+        "available_until", current_date + datetime.timedelta(days=30)
+    )
+
+    new_change = {
+        "token": template["save_token"],
+        "thumbnail_url": template["thumbnail_url"],
+        "variant": {
+            "id": template.get("variant_id", ""),
+            "name": "",
+        },
+        "created_at": created_at,
+    }
+
+    return {
+        "_id": ObjectId(),
+        # lets the sync find the project of a removed template
+        "template_id": template["_id"],
+        "name": "",
+        "tool": "old_printess_save",
+        "source": "shopify",
+        "customer_id": template["customer_id"],
+        "product": {
+            "id": template.get("product_id", ""),
+            "name": template.get("product_name", ""),
+            "handle": template.get("product_handle", ""),
+        },
+        "changes": [new_change],
+        "current": new_change,
+        "is_deleted": False,
+        # "is_copied": template.get("copied", False),
+        "created_at": created_at,
+        "updated_at": created_at,
+        "available_until": available_until,
+    }
+
+
+def template_is_active(template, current_date):
+    """Python version of the migrate() query for a single template."""
+    available_until = template.get("available_until")
+    if available_until and available_until.tzinfo is None:
+        available_until = available_until.replace(tzinfo=datetime.timezone.utc)
+    return (
+        not template.get("deleted", False)
+        and not template.get("copied", False)
+        and available_until is not None
+        and available_until >= current_date
+    )
+
+
+def register_token(collection_token, project, current_date):
+    token = project["current"]["token"]
+    try:
+        collection_token.insert_one(
+            {
+                "token": token,
+                "project_id": project["_id"],
+                "customer_id": project["customer_id"],
+                "created_at": current_date,
+            }
+        )
+        return True
+    except DuplicateKeyError:
+        pass
+
+    # token already registered for another project, unless that project
+    # was never written because a run died between registration and insert
+    entry = collection_token.find_one({"token": token})
+    if not entry or not is_orphaned_token(collection_token, entry):
+        return False
+    return (
+        collection_token.update_one(
+            {"token": token, "project_id": entry["project_id"]},
+            {
+                "$set": {
+                    "project_id": project["_id"],
+                    "customer_id": project["customer_id"],
+                    "created_at": current_date,
+                }
+            },
+        ).modified_count
+        == 1
+    )
+
+
+def is_orphaned_token(collection_token, entry):
+    created_at = entry.get("created_at")
+    if created_at:
+        if created_at.tzinfo is None:
+            created_at = created_at.replace(tzinfo=datetime.timezone.utc)
+        age = datetime.datetime.now(datetime.timezone.utc) - created_at
+        if age.total_seconds() < TOKEN_ORPHAN_SECONDS:
+            return False
+    db = collection_token.database
+    query = {"_id": entry["project_id"]}
+    return (
+        db["jep_tools__customer_project"].find_one(query, {"_id": 1}) is None
+        and db["jep_tools__customer_project_archive"].find_one(
+            query, {"_id": 1}
+        )
+        is None
+    )
+
+
+def insert_project(collection_new, collection_token, project, current_date):
+    """
+    Register the token of project and insert it. The registration is
+    undone if the insert fails, so the token does not stay blocked.
+    """
+    if not register_token(collection_token, project, current_date):
+        return False
+    try:
+        collection_new.insert_one(project)
+    except Exception:
+        collection_token.delete_one(
+            {"token": project["current"]["token"], "project_id": project["_id"]}
+        )
+        raise
+    return True
+
+
+def migrate():
+    collection_old, collection_new, collection_token = get_collections(
+        get_connection()
+    )
 
     current_date = datetime.datetime.now(datetime.timezone.utc)
 
@@ -31,39 +177,7 @@ def migrate():
     migrated_count = 0
     for template in tqdm(templates, total=total, desc="Migriere Templates"):
         # migrate to new collection
-        created_at = template.get("created_at", current_date)
-        available_until = template.get(
-            "available_until", current_date + datetime.timedelta(days=30)
-        )
-
-        new_change = {
-            "token": template["save_token"],
-            "thumbnail_url": template["thumbnail_url"],
-            "variant": {
-                "id": template.get("variant_id", ""),
-                "name": "",
-            },
-            "created_at": created_at,
-        }
-
-        new_data = {
-            "name": "",
-            "tool": "old_printess_save",
-            "source": "shopify",
-            "customer_id": template["customer_id"],
-            "product": {
-                "id": template.get("product_id", ""),
-                "name": template.get("product_name", ""),
-                "handle": template.get("product_handle", ""),
-            },
-            "changes": [new_change],
-            "current": new_change,
-            "is_deleted": False,
-            # "is_copied": template.get("copied", False),
-            "created_at": created_at,
-            "updated_at": created_at,
-            "available_until": available_until,
-        }
+        new_data = template_to_project(template, current_date)
 
         # check if already exists
         existing_project = collection_new.find_one(
@@ -73,11 +187,229 @@ def migrate():
             # print("Project already exists")
             continue
 
-        collection_new.insert_one(new_data)
+        if not insert_project(
+            collection_new, collection_token, new_data, current_date
+        ):
+            continue
         migrated_count += 1
     print(
         f"Migration abgeschlossen: {migrated_count} von {total} Templates migriert"
     )
 
 
-migrate()
+def untouched_since_migration(filters):
+    """
+    Filter of migrated projects that were not saved in the new tool since,
+    their only change is still the one of the template.
+    """
+    return {**filters, "tool": "old_printess_save", "changes": {"$size": 1}}
+
+
+def apply_template_changes(
+    collection_new, collection_token, templates, removed_template_ids=()
+):
+    """
+    Apply the latest state of changed templates to the migrated projects.
+    New active templates are migrated, projects migrated from a template
+    are updated, or soft deleted once the template is deleted, copied or
+    removed. Projects saved in the new tool since are left alone.
+    """
+    current_date = datetime.datetime.now(datetime.timezone.utc)
+    existing_tokens = {
+        change["token"]
+        for project in collection_new.find(
+            {"changes.token": {"$in": list(templates)}},
+            {"changes.token": 1},
+        )
+        for change in project["changes"]
+    }
+
+    operations = []
+    for token, template in templates.items():
+        is_active = template_is_active(template, current_date)
+        if token not in existing_tokens:
+            if not is_active:
+                continue
+            new_data = template_to_project(template, current_date)
+            insert_project(
+                collection_new, collection_token, new_data, current_date
+            )
+            continue
+
+        filters = untouched_since_migration({"current.token": token})
+        if is_active:
+            new_data = template_to_project(template, current_date)
+            update = {
+                key: new_data[key]
+                for key in ("product", "changes", "current", "available_until")
+            }
+            update["updated_at"] = current_date
+        else:
+            update = {
+                "is_deleted": True,
+                "deleted_at": current_date,
+                "updated_at": current_date,
+            }
+        operations.append(UpdateOne(filters, {"$set": update}))
+
+    # projects migrated before template_id was stored are not found
+    if removed_template_ids:
+        operations.append(
+            UpdateMany(
+                untouched_since_migration(
+                    {
+                        "template_id": {"$in": list(removed_template_ids)},
+                        "is_deleted": False,
+                    }
+                ),
+                {
+                    "$set": {
+                        "is_deleted": True,
+                        "deleted_at": current_date,
+                        "updated_at": current_date,
+                    }
+                },
+            )
+        )
+
+    if operations:
+        collection_new.bulk_write(operations, ordered=False)
+
+
+def sync():
+    """
+    Continuously sync the legacy templates through a change stream.
+
+    On the first run the change stream is opened before the full migration,
+    so writes during the migration are picked up afterwards. The resume
+    token is stored after every batch, a restarted sync continues there.
+    """
+    connection = get_connection()
+    collection_old, collection_new, collection_token = get_collections(
+        connection
+    )
+    collection_state = connection["kleineprints"]["jep_tools__migration_state"]
+
+    state = collection_state.find_one({"_id": SYNC_STATE_ID})
+    resume_token = state["resume_token"] if state else None
+
+    with collection_old.watch(
+        [
+            {
+                "$match": {
+                    "operationType": {
+                        "$in": ["insert", "update", "replace", "delete"]
+                    }
+                }
+            }
+        ],
+        full_document="updateLookup",
+        resume_after=resume_token,
+        max_await_time_ms=SYNC_MAX_AWAIT_MS,
+    ) as stream:
+        if not resume_token:
+            collection_state.replace_one(
+                {"_id": SYNC_STATE_ID},
+                {"resume_token": stream.resume_token},
+                upsert=True,
+            )
+            migrate()
+
+        print("Warte auf Änderungen an Templates")
+        while stream.alive:
+            # latest state per token, later changes win
+            templates = {}
+            removed_template_ids = set()
+            while len(templates) + len(removed_template_ids) < SYNC_BATCH_SIZE:
+                change = stream.try_next()
+                if change is None:
+                    break
+                if change["operationType"] == "delete":
+                    template_id = change["documentKey"]["_id"]
+                    removed_template_ids.add(template_id)
+                    templates = {
+                        token: template
+                        for token, template in templates.items()
+                        if template["_id"] != template_id
+                    }
+                    continue
+                template = change.get("fullDocument")
+                if template and template.get("save_token"):
+                    templates[template["save_token"]] = template
+
+            if templates or removed_template_ids:
+                apply_template_changes(
+                    collection_new,
+                    collection_token,
+                    templates,
+                    removed_template_ids,
+                )
+                print(
+                    f"{len(templates) + len(removed_template_ids)} "
+                    "Templates synchronisiert"
+                )
+
+            if stream.resume_token:
+                collection_state.replace_one(
+                    {"_id": SYNC_STATE_ID},
+                    {"resume_token": stream.resume_token},
+                    upsert=True,
+                )
+
+
+def register_tokens():
+    """
+    Backfill the token registry with every token of every project, so token
+    lookups no longer need to search the changes of all projects. Entries
+    registered without a customer_id get the one of their project.
+    """
+    connection = get_connection()
+    _, collection_new, collection_token = get_collections(connection)
+    current_date = datetime.datetime.now(datetime.timezone.utc)
+
+    total = collection_new.estimated_document_count()
+    projects = collection_new.find(
+        {}, {"customer_id": 1, "changes.token": 1}
+    ).batch_size(REGISTER_BATCH_SIZE)
+
+    operations = []
+    conflicts = 0
+    for project in tqdm(projects, total=total, desc="Registriere Tokens"):
+        for change in project.get("changes", []):
+            if not change.get("token"):
+                continue
+            operations.append(
+                UpdateOne(
+                    {"token": change["token"], "project_id": project["_id"]},
+                    {
+                        "$set": {"customer_id": project.get("customer_id")},
+                        "$setOnInsert": {"created_at": current_date},
+                    },
+                    upsert=True,
+                )
+            )
+        if len(operations) >= REGISTER_BATCH_SIZE:
+            conflicts += write_registrations(collection_token, operations)
+            operations = []
+    if operations:
+        conflicts += write_registrations(collection_token, operations)
+    print(f"Tokens registriert, {conflicts} Tokens gehören anderen Projekten")
+
+
+def write_registrations(collection_token, operations):
+    """Write registry upserts, returns the number of conflicting tokens."""
+    try:
+        collection_token.bulk_write(operations, ordered=False)
+    except BulkWriteError as e:
+        # token already registered for another project
+        return len(e.details["writeErrors"])
+    return 0
+
+
+if __name__ == "__main__":
+    if "--register-tokens" in sys.argv:
+        register_tokens()
+    elif "--sync" in sys.argv:
+        sync()
+    else:
+        migrate()
@@ -1,30 +1,365 @@
 import datetime
+import hmac
 import json
-from .utils.decorators import api
+import os
+import zlib
+from .utils.decorators import api, get_header, CUSTOMERS
 from .utils.response import APIResponse
-from .utils.database_connection import get_connection
+from .utils.database_connection import (
+    get_tenant_database,
+    secondary_preferred,
+)
+from .utils.response_cache import LRUStore, MongoStore, ResponseCache
+from .utils import idempotency
 import pymongo
+from pymongo import ReadPreference
+from pymongo.errors import DuplicateKeyError
 from bson import ObjectId
 
 
 TABLE_NAME = "jep_tools__customer_project"
+ARCHIVE_TABLE_NAME = "jep_tools__customer_project_archive"
+TOKEN_TABLE_NAME = "jep_tools__customer_project_token"
+CACHE_TABLE_NAME = "jep_tools__customer_project_cache"
+CACHE_VERSION_TABLE_NAME = "jep_tools__customer_project_cache_version"
+TOMBSTONE_TABLE_NAME = "jep_tools__customer_project_tombstone"
+
+# projects stay in the hot collection for this long after expiry / deletion
+ARCHIVE_GRACE_DAYS = int(os.environ.get("ARCHIVE_GRACE_DAYS", "30"))
+ARCHIVE_BATCH_SIZE = int(os.environ.get("ARCHIVE_BATCH_SIZE", "500"))
+# archived projects are dropped by a TTL index after this many days (0 = keep)
+ARCHIVE_RETENTION_DAYS = int(os.environ.get("ARCHIVE_RETENTION_DAYS", "0"))
+
+# delta sync watermarks trail the request time to cover in-flight writes
+SYNC_WATERMARK_LAG = datetime.timedelta(seconds=5)
+SYNC_INDEX = [
+    ("customer_id", pymongo.ASCENDING),
+    ("updated_at", pymongo.ASCENDING),
+]
+# tombstones of archived projects are dropped after this many days, clients
+# syncing less often have to load all projects again
+SYNC_TOMBSTONE_DAYS = int(os.environ.get("SYNC_TOMBSTONE_DAYS", "90"))
+
+# registry entries without a project are only taken over once they are
+# older than any request that could still be writing the project
+TOKEN_ORPHAN_SECONDS = 5 * 60
+
+# tokens saved before the token registry existed are looked up in the
+# changes of all projects, which reaches every shard. Safe to set to 0 once
+# every writer registers its tokens (create here, the migration and its
+# --sync) and migrate_projects.py --register-tokens was run after they
+# were deployed, so no token remains that only exists in the changes.
+# Archived projects are still found through the archive fallback.
+LEGACY_TOKEN_LOOKUP = os.environ.get("LEGACY_TOKEN_LOOKUP", "1") == "1"
+
+EXPORT_BATCH_SIZE = 500
+# a single export response stops after this many documents or
+# compressed bytes, the client resumes with the returned watermark
+EXPORT_MAX_DOCUMENTS = int(os.environ.get("EXPORT_MAX_DOCUMENTS", "20000"))
+EXPORT_MAX_BYTES = int(os.environ.get("EXPORT_MAX_BYTES", str(4 * 1024 * 1024)))
+# export credentials by tenant, e.g. {"kleineprints": "..."}, sent as
+# X-Export-Key next to the API key. Tenants without one cannot export.
+EXPORT_API_KEYS = json.loads(os.environ.get("EXPORT_API_KEYS") or "{}")
+
+SUMMARY_EXPIRING_DAYS = 7
+# larger windows overflow the date range
+SUMMARY_MAX_EXPIRING_DAYS = 3650
+# covers the summary aggregation, no documents have to be fetched
+SUMMARY_INDEX = [
+    ("customer_id", pymongo.ASCENDING),
+    ("is_deleted", pymongo.ASCENDING),
+    ("available_until", pymongo.ASCENDING),
+    ("tool", pymongo.ASCENDING),
+    ("product.id", pymongo.ASCENDING),
+]
+
+# "memory" (per container) or "mongo" (shared by all containers)
+PROJECTS_CACHE_STORE = os.environ.get("PROJECTS_CACHE_STORE", "memory")
+# cached GET /projects responses per customer, invalidated on every write
+PROJECTS_CACHE = ResponseCache(
+    "projects",
+    CACHE_VERSION_TABLE_NAME,
+    (
+        MongoStore(CACHE_TABLE_NAME)
+        if PROJECTS_CACHE_STORE == "mongo"
+        else LRUStore()
+    ),
+)
+
+
+def primary_collection(db):
+    return db[TABLE_NAME].with_options(read_preference=ReadPreference.PRIMARY)
+
+
+# reads the primary: the cache version counter and cache misses, so no
+# stale result is cached. Only MongoStore cache hits read a secondary.
+@api(read_preference=secondary_preferred())
+def collection(request):
+    customer_id = request.queryStringParameters.get("customer_id")
+    if not customer_id:
+        return APIResponse.bad_request("customer_id is required")
+
+    cache_key = PROJECTS_CACHE.key(
+        request.db, customer_id, request.queryStringParameters
+    )
+    cached = PROJECTS_CACHE.get(request.db, cache_key)
+    if cached is not None:
+        return cached, 200
+
+    updated_since = request.queryStringParameters.get("updated_since")
+    if updated_since:
+        try:
+            updated_since = datetime.datetime.fromisoformat(
+                updated_since.replace("Z", "+00:00")
+            )
+        except ValueError:
+            return APIResponse.bad_request("updated_since must be ISO 8601")
+        if updated_since.tzinfo is None:
+            updated_since = updated_since.replace(tzinfo=datetime.timezone.utc)
+        response = APIResponse.ok(
+            sync_projects(request.db, customer_id, updated_since)
+        )
+    else:
+        # cache misses read from the primary, so no stale secondary read is
+        # stored in the cache after a write invalidated it
+        projects = (
+            primary_collection(request.db)
+            .find({"customer_id": customer_id, "is_deleted": False})
+            .sort(
+                [
+                    ("created_at", pymongo.DESCENDING),
+                    ("_id", pymongo.DESCENDING),
+                ]
+            )
+        )
+        response = APIResponse.ok({"projects": list(projects)})
 
+    PROJECTS_CACHE.set(request.db, cache_key, response[0])
+    return response
 
-@api
-def collection(request):
+
+def sync_projects(db, customer_id, updated_since):
+    """
+    Projects of a customer changed since updated_since. Deleted and
+    archived projects are returned as tombstones, the watermark is the
+    updated_since of the next sync.
+    """
+    watermark = (
+        datetime.datetime.now(datetime.timezone.utc) - SYNC_WATERMARK_LAG
+    )
+
+    # read from the primary, a lagging secondary could miss changes that are
+    # already behind the watermark
+    changed = (
+        db.get_collection(TABLE_NAME, read_preference=ReadPreference.PRIMARY)
+        .find(
+            {"customer_id": customer_id, "updated_at": {"$gt": updated_since}}
+        )
+        .sort([("updated_at", pymongo.ASCENDING)])
+    )
+
+    projects = []
+    deleted = []
+    for project in changed:
+        if project.get("is_deleted"):
+            deleted.append(
+                {"_id": project["_id"], "deleted_at": project.get("deleted_at")}
+            )
+        else:
+            projects.append(project)
+
+    archived = db.get_collection(
+        TOMBSTONE_TABLE_NAME, read_preference=ReadPreference.PRIMARY
+    ).find({"customer_id": customer_id, "updated_at": {"$gt": updated_since}})
+    deleted.extend(
+        {"_id": tombstone["_id"], "deleted_at": tombstone["deleted_at"]}
+        for tombstone in archived
+    )
+
+    return {
+        "projects": projects,
+        "deleted": deleted,
+        # Z instead of +00:00, which breaks when echoed in a query string
+        "watermark": watermark.isoformat(timespec="milliseconds").replace(
+            "+00:00", "Z"
+        ),
+    }
+
+
+# reads the primary like collection(), see there
+@api(read_preference=secondary_preferred())
+def summary(request):
     customer_id = request.queryStringParameters.get("customer_id")
     if not customer_id:
         return APIResponse.bad_request("customer_id is required")
+    expiring_days = request.queryStringParameters.get(
+        "expiring_days", str(SUMMARY_EXPIRING_DAYS)
+    )
+    if not expiring_days.isdigit():
+        return APIResponse.bad_request("expiring_days must be a number")
+    if int(expiring_days) > SUMMARY_MAX_EXPIRING_DAYS:
+        return APIResponse.bad_request(
+            f"expiring_days must be at most {SUMMARY_MAX_EXPIRING_DAYS}"
+        )
+
+    cache_key = PROJECTS_CACHE.key(
+        request.db,
+        customer_id,
+        {"summary": True, **request.queryStringParameters},
+    )
+    cached = PROJECTS_CACHE.get(request.db, cache_key)
+    if cached is not None:
+        return cached, 200
+
+    now = datetime.datetime.now(datetime.timezone.utc)
+    expiring_until = now + datetime.timedelta(days=int(expiring_days))
+    is_active = {"$gte": ["$available_until", now]}
+    is_expiring = {
+        "$and": [is_active, {"$lt": ["$available_until", expiring_until]}]
+    }
+    totals_stage = {
+        "$group": {
+            "_id": None,
+            "total": {"$sum": 1},
+            "active": {"$sum": {"$cond": [is_active, 1, 0]}},
+            "expiring": {"$sum": {"$cond": [is_expiring, 1, 0]}},
+        }
+    }
+    pipeline = [
+        {"$match": {"customer_id": customer_id, "is_deleted": False}},
+        # only indexed fields, so the index covers the whole pipeline
+        {
+            "$project": {
+                "_id": 0,
+                "available_until": 1,
+                "tool": 1,
+                "product.id": 1,
+            }
+        },
+        {
+            "$facet": {
+                "totals": [totals_stage],
+                "products": [
+                    {"$group": {"_id": "$product.id", "count": {"$sum": 1}}}
+                ],
+                "tools": [{"$group": {"_id": "$tool", "count": {"$sum": 1}}}],
+            }
+        },
+    ]
+    # from the primary like collection(), the result is cached
+    result = next(primary_collection(request.db).aggregate(pipeline))
 
+    totals = result["totals"][0] if result["totals"] else {}
+    response = APIResponse.ok(
+        {
+            "total": totals.get("total", 0),
+            "active": totals.get("active", 0),
+            "expiring": totals.get("expiring", 0),
+            "expiring_days": int(expiring_days),
+            "products": {
+                str(product["_id"]): product["count"]
+                for product in result["products"]
+            },
+            "tools": {
+                str(tool["_id"]): tool["count"] for tool in result["tools"]
+            },
+        }
+    )
+    PROJECTS_CACHE.set(request.db, cache_key, response[0])
+    return response
+
+
+@api(read_preference=secondary_preferred())
+def export(request):
+    """
+    Export all projects of the tenant as gzip compressed NDJSON, ordered by
+    _id. Documents are compressed while the cursor is read, responses stop
+    at EXPORT_MAX_DOCUMENTS / EXPORT_MAX_BYTES and return the last _id in
+    X-Export-After, which is passed as after to continue.
+
+    Requires the export key of the tenant in X-Export-Key, the API key of
+    the storefront alone is not enough. Tokens are only exported with
+    tokens=1.
+    """
+    export_key = EXPORT_API_KEYS.get(request.customer)
+    given_key = get_header(request.event.get("headers") or {}, "x-export-key")
+    if not export_key or not hmac.compare_digest(
+        export_key.encode("utf-8"), (given_key or "").encode("utf-8")
+    ):
+        return APIResponse.not_authorized()
+
+    params = request.queryStringParameters
+    query = {}
+    if params.get("customer_id"):
+        query["customer_id"] = params["customer_id"]
+    if params.get("after"):
+        if not ObjectId.is_valid(params["after"]):
+            return APIResponse.bad_request("after must be a project id")
+        query["_id"] = {"$gt": ObjectId(params["after"])}
+    try:
+        updated_at = {
+            operator: datetime.datetime.fromisoformat(params[param])
+            for operator, param in (
+                ("$gte", "updated_from"),
+                ("$lt", "updated_to"),
+            )
+            if params.get(param)
+        }
+    except ValueError:
+        return APIResponse.bad_request("updated_from/to must be ISO 8601")
+    if updated_at:
+        query["updated_at"] = updated_at
+
+    # the full change history and the tokens are only exported on request
+    projection = {}
+    if params.get("changes") != "1":
+        projection["changes"] = 0
+    if params.get("tokens") != "1":
+        projection["current.token"] = 0
+        if "changes" not in projection:
+            projection["changes.token"] = 0
     projects = (
         request.db[TABLE_NAME]
-        .find({"customer_id": customer_id, "is_deleted": False})
-        .sort([("created_at", pymongo.DESCENDING), ("_id", pymongo.DESCENDING)])
+        .find(query, projection or None)
+        .sort("_id", pymongo.ASCENDING)
+        .batch_size(EXPORT_BATCH_SIZE)
     )
-    return APIResponse.ok({"projects": list(projects)})
 
+    compressor = zlib.compressobj(6, zlib.DEFLATED, zlib.MAX_WBITS | 16)
+    chunks = []
+    size = 0
+    count = 0
+    last_id = None
+    complete = True
+    for project in projects:
+        if count >= EXPORT_MAX_DOCUMENTS or size >= EXPORT_MAX_BYTES:
+            complete = False
+            break
+        chunk = compressor.compress(
+            (json.dumps(project, default=str) + "\n").encode("utf-8")
+        )
+        if chunk:
+            chunks.append(chunk)
+            size += len(chunk)
+        count += 1
+        last_id = project["_id"]
+    projects.close()
+    chunks.append(compressor.flush())
+
+    headers = {"Content-Encoding": "gzip", "X-Export-Count": str(count)}
+    if not complete:
+        headers["X-Export-After"] = str(last_id)
+    return (
+        b"".join(chunks),
+        200,
+        "application/x-ndjson",
+        None,
+        True,
+        headers,
+    )
 
-@api
+
+@api(read_preference=secondary_preferred())
 def get(request):
     id = request.pathParameters.get("id")
     if not id:
@@ -40,7 +375,7 @@ def get(request):
     return APIResponse.ok(project)
 
 
-@api
+@api(idempotent=True)
 def create(request):
     collection = request.db[TABLE_NAME]
     # copy_project_id = request.pathParameters.get("id") # ObjectId(id)
@@ -60,51 +395,67 @@ def create(request):
     #        return APIResponse.not_found("project not found")
     #    current_change = copy_project.get("current")
 
-    current_change = inc_body.get("current")
-
-    new_change = {
-        "token": current_change["token"],
-        "thumbnail_url": current_change["thumbnail_url"],
-        "variant": {
-            "id": current_change["variant"].get("id", None),
-            "name": current_change["variant"].get("name", None),
-        },
-        "created_at": datetime_current,
-    }
+    try:
+        current_change = inc_body["current"]
+        new_change = {
+            "token": current_change["token"],
+            "thumbnail_url": current_change["thumbnail_url"],
+            "variant": {
+                "id": current_change["variant"].get("id", None),
+                "name": current_change["variant"].get("name", None),
+            },
+            "created_at": datetime_current,
+        }
+        token_old = inc_body["token_old"]
+    except (KeyError, TypeError, AttributeError):
+        return APIResponse.bad_request(
+            "current with token, thumbnail_url and variant and token_old "
+            "are required"
+        )
 
     # cancel if token is empty else every new project will be saved in one and the same project
     if not new_change["token"]:
         return APIResponse.bad_request("token is required")
 
     # check if token_old alread exists in DB
-    existing_project = collection.find_one(
-        {"changes.token": inc_body["token_old"]}
+    existing_project = find_project_by_token(
+        request.db, token_old, inc_body.get("customer_id")
     )
 
     available_until = datetime_current + datetime.timedelta(days=30)
+    project_id = existing_project["_id"] if existing_project else ObjectId()
+    customer_id = inc_body.get("customer_id")
+    if existing_project and not (
+        customer_id and existing_project.get("customer_id")
+    ):
+        customer_id = existing_project.get("customer_id")
+
     if not existing_project:
         # create new project
-        new_project = {
-            "name": inc_body.get("name", ""),
-            "tool": inc_body["tool"],
-            "source": inc_body["source"],
-            "customer_id": inc_body["customer_id"],
-            "template_name": inc_body.get("template_name", ""),
-            "product": {
-                "id": inc_body["product"]["id"],
-                "name": inc_body["product"]["name"],
-                "handle": inc_body["product"]["handle"],
-            },
-            "changes": [new_change],
-            "current": new_change,
-            "is_deleted": False,
-            "created_at": datetime_current,
-            "updated_at": datetime_current,
-            "available_until": available_until,
-        }
-        new_project = collection.insert_one(new_project)
-        project = collection.find_one({"_id": new_project.inserted_id})
-        return APIResponse.ok(project)
+        try:
+            new_project = {
+                "_id": project_id,
+                "name": inc_body.get("name", ""),
+                "tool": inc_body["tool"],
+                "source": inc_body["source"],
+                "customer_id": inc_body["customer_id"],
+                "template_name": inc_body.get("template_name", ""),
+                "product": {
+                    "id": inc_body["product"]["id"],
+                    "name": inc_body["product"]["name"],
+                    "handle": inc_body["product"]["handle"],
+                },
+                "changes": [new_change],
+                "current": new_change,
+                "is_deleted": False,
+                "created_at": datetime_current,
+                "updated_at": datetime_current,
+                "available_until": available_until,
+            }
+        except (KeyError, TypeError):
+            return APIResponse.bad_request(
+                "tool, source, customer_id and product are required"
+            )
     else:
         # set current to new change and append new change to changes in mongodb
         update_operation = {
@@ -118,14 +469,47 @@ def create(request):
         if inc_body.get("customer_id") and existing_project.get("customer_id"):
             update_operation["$set"]["customer_id"] = inc_body["customer_id"]
 
-        updated = collection.update_one(
-            {"_id": existing_project["_id"]}, update_operation
-        )
-        if updated.modified_count == 1:
-            project = collection.find_one({"_id": existing_project["_id"]})
-            return APIResponse.ok(project)
+    # the unique index on the registry rejects tokens that are already in
+    # use. Registered right before the write and undone if the write fails,
+    # so a failed request does not keep the token.
+    if not register_token(
+        request.db, new_change["token"], project_id, customer_id
+    ):
+        return APIResponse.conflict("token already exists")
+    try:
+        if not existing_project:
+            collection.insert_one(new_project)
+            written = True
+        else:
+            written = (
+                collection.update_one(
+                    {
+                        "_id": existing_project["_id"],
+                        "customer_id": existing_project.get("customer_id"),
+                    },
+                    update_operation,
+                ).modified_count
+                == 1
+            )
+    except Exception:
+        unregister_token(request.db, new_change["token"], project_id)
+        raise
+    if not written:
+        unregister_token(request.db, new_change["token"], project_id)
+        return APIResponse.error_unknown("unknown error occured")
 
-    return APIResponse.error_unknown("unknown error occured")
+    if not existing_project:
+        PROJECTS_CACHE.invalidate(request.db, inc_body["customer_id"])
+    else:
+        PROJECTS_CACHE.invalidate(
+            request.db,
+            existing_project.get("customer_id", ""),
+            update_operation["$set"].get("customer_id", ""),
+        )
+    project = collection.find_one(
+        {"_id": project_id, "customer_id": customer_id}
+    )
+    return APIResponse.ok(project)
 
 
 @api
@@ -144,16 +528,31 @@ def update(request):
     if "customer_id" in update_data and existng_project.get("customer_id") != "":
         return APIResponse.bad_request("customer_id cannot be changed to a different value")
 
-    filters = {"_id": ObjectId(id)}
-    if existng_project.get("customer_id") != "":
-        filters["customer_id"] = customer_id
+    # the stored customer_id is the shard key, it targets a single shard
+    filters = {
+        "_id": ObjectId(id),
+        "customer_id": existng_project.get("customer_id"),
+    }
 
+    update_data["updated_at"] = datetime.datetime.now(datetime.timezone.utc)
     updated = request.db[TABLE_NAME].update_one(
         filters, {"$set": update_data}
     )
 
     if updated.modified_count == 1:
-        project = request.db[TABLE_NAME].find_one({"_id": ObjectId(id)})
+        PROJECTS_CACHE.invalidate(
+            request.db,
+            existng_project.get("customer_id", ""),
+            update_data.get("customer_id", ""),
+        )
+        project = request.db[TABLE_NAME].find_one(
+            {
+                "_id": ObjectId(id),
+                "customer_id": update_data.get(
+                    "customer_id", existng_project.get("customer_id")
+                ),
+            }
+        )
         return APIResponse.ok(project)
     return APIResponse.error_unknown("unknown error occured")
 
@@ -169,47 +568,204 @@ def delete(request):
     if not customer_matched:
         return APIResponse.bad_request("customer_id does not match the project")
 
+    datetime_current = datetime.datetime.now(datetime.timezone.utc)
     updated = request.db[TABLE_NAME].update_one(
         {"_id": ObjectId(id), "customer_id": customer_id},
         {
             "$set": {
                 "is_deleted": True,
-                "deleted_at": datetime.datetime.now(datetime.timezone.utc),
+                "deleted_at": datetime_current,
+                # lets delta syncs pick up the tombstone
+                "updated_at": datetime_current,
             }
         },
     )
     if updated.modified_count == 1:
+        PROJECTS_CACHE.invalidate(request.db, customer_id)
         return APIResponse.ok_nobody()
     return APIResponse.error_unknown("unknown error occured")
 
+def find_project_by_token(db, token, customer_id=None):
+    """Find a project by one of its change tokens.
+
+    Resolves the token through the token registry, which stores the
+    customer_id (the shard key) next to the project id, so the lookup
+    targets a single shard. Tokens saved before the registry existed are
+    looked up in the changes and registered on the way, first among the
+    projects of customer_id and guest projects if it is given. Falls back
+    to the archive and moves the project back into the hot collection if it
+    was archived in the meantime.
+    """
+    if not token:
+        return None
+
+    entry = db[TOKEN_TABLE_NAME].find_one({"token": token})
+    if entry:
+        project = find_registered_project(db, entry)
+        return project or restore_project(db, {"_id": entry["project_id"]})
+
+    project = None
+    if LEGACY_TOKEN_LOOKUP:
+        query = {"changes.token": token}
+        if customer_id:
+            project = db[TABLE_NAME].find_one(
+                {**query, "customer_id": {"$in": [customer_id, ""]}}
+            )
+        if not project:
+            project = db[TABLE_NAME].find_one(query)
+    if not project:
+        project = restore_project(db, {"changes.token": token})
+    if project:
+        register_token(db, token, project["_id"], project.get("customer_id"))
+    return project
+
+
+def find_registered_project(db, entry):
+    """
+    Project of a token registry entry. Entries registered without a
+    customer_id, or whose project changed its customer since, are looked up
+    by _id on all shards and updated on the way.
+    """
+    if "customer_id" in entry:
+        project = db[TABLE_NAME].find_one(
+            {"_id": entry["project_id"], "customer_id": entry["customer_id"]}
+        )
+        if project:
+            return project
+
+    project = db[TABLE_NAME].find_one({"_id": entry["project_id"]})
+    if project:
+        db[TOKEN_TABLE_NAME].update_one(
+            {"token": entry["token"]},
+            {"$set": {"customer_id": project.get("customer_id")}},
+        )
+    return project
+
+
+def register_token(db, token, project_id, customer_id):
+    """Register token for project_id of customer_id.
+
+    Returns False if the token is already registered for another project.
+    """
+    collection = db[TOKEN_TABLE_NAME]
+    try:
+        collection.insert_one(
+            {
+                "token": token,
+                "project_id": project_id,
+                "customer_id": customer_id,
+                "created_at": datetime.datetime.now(datetime.timezone.utc),
+            }
+        )
+    except DuplicateKeyError:
+        entry = collection.find_one({"token": token})
+        if not entry:
+            return False
+        if entry["project_id"] == project_id:
+            return True
+        if not is_orphaned_token(db, entry):
+            return False
+        # take over the entry of a request that died before its write
+        return (
+            collection.update_one(
+                {"token": token, "project_id": entry["project_id"]},
+                {
+                    "$set": {
+                        "project_id": project_id,
+                        "customer_id": customer_id,
+                        "created_at": datetime.datetime.now(
+                            datetime.timezone.utc
+                        ),
+                    }
+                },
+            ).modified_count
+            == 1
+        )
+    return True
+
+
+def unregister_token(db, token, project_id):
+    db[TOKEN_TABLE_NAME].delete_one({"token": token, "project_id": project_id})
+
+
+def is_orphaned_token(db, entry):
+    """
+    Whether the registry entry belongs to a project that was never written,
+    e.g. because the Lambda was killed between registration and insert.
+    Entries younger than TOKEN_ORPHAN_SECONDS may still be in flight.
+    """
+    created_at = entry.get("created_at")
+    if created_at:
+        if created_at.tzinfo is None:
+            created_at = created_at.replace(tzinfo=datetime.timezone.utc)
+        age = datetime.datetime.now(datetime.timezone.utc) - created_at
+        if age.total_seconds() < TOKEN_ORPHAN_SECONDS:
+            return False
+    query = {"_id": entry["project_id"]}
+    return (
+        db[TABLE_NAME].find_one(query, {"_id": 1}) is None
+        and db[ARCHIVE_TABLE_NAME].find_one(query, {"_id": 1}) is None
+    )
+
+
+def restore_project(db, query):
+    archived = db[ARCHIVE_TABLE_NAME].find_one(query)
+    if not archived:
+        return None
+    archived.pop("archived_at", None)
+    # delta syncs pick the restored project up as changed, no longer deleted
+    archived["updated_at"] = datetime.datetime.now(datetime.timezone.utc)
+    db[TABLE_NAME].replace_one(
+        {"_id": archived["_id"], "customer_id": archived.get("customer_id")},
+        archived,
+        upsert=True,
+    )
+    db[TOMBSTONE_TABLE_NAME].delete_one({"_id": archived["_id"]})
+    db[ARCHIVE_TABLE_NAME].delete_one({"_id": archived["_id"]})
+    PROJECTS_CACHE.invalidate(db, archived.get("customer_id", ""))
+    return archived
+
+
 def check_customer_id_match(db, id, customer_id):
     # check if customer_id is set on project (DB). If it is, make sure it matches the query param. If not ignore an empty customer_id in query param
     if not ObjectId.is_valid(id):
         return False, None
-    existing_project = db[TABLE_NAME].find_one({"_id": ObjectId(id)})
-    if existing_project and existing_project.get("customer_id"):
-        if existing_project["customer_id"] != customer_id:
-            return False, existing_project
+    # queried by shard key, first the project of customer_id, then a guest
+    # project. A project of another customer is not found.
+    existing_project = None
+    for customer_ids in ([customer_id], ["", None]):
+        existing_project = db[TABLE_NAME].find_one(
+            {"_id": ObjectId(id), "customer_id": {"$in": customer_ids}}
+        )
+        if existing_project:
+            break
+    if not existing_project:
+        return False, None
     return True, existing_project
 
 
 def events_produce(event, context):
-    db_connection = get_connection()
     if event.get("Records"):
         for record in event["Records"]:
             body = record["Sns"].get("Message", {})
             if type(body) == str:
                 body = json.loads(body)
 
-            collection = db_connection[body["tenant"]][TABLE_NAME]
+            db = get_tenant_database(body["tenant"])
+            collection = db[TABLE_NAME]
             # find project by token
-            project = collection.find_one({"changes.token": body["token"]})
+            project = find_project_by_token(
+                db, body["token"], body.get("customer_id")
+            )
             if not project:
                 raise Exception(f"project by token {body['token']} not found")
 
             # update project
             updated = collection.update_one(
-                {"_id": project["_id"]},
+                {
+                    "_id": project["_id"],
+                    "customer_id": project.get("customer_id"),
+                },
                 {
                     "$set": {
                         "available_until": datetime.datetime.fromisoformat(
@@ -230,3 +786,127 @@ def events_produce(event, context):
             )
             if updated.modified_count != 1:
                 raise Exception("project not updated")
+            PROJECTS_CACHE.invalidate(db, project.get("customer_id", ""))
+
+
+def archive(event, context):
+    """Scheduled job moving expired and long deleted projects to the archive."""
+    threshold = datetime.datetime.now(
+        datetime.timezone.utc
+    ) - datetime.timedelta(days=ARCHIVE_GRACE_DAYS)
+    query = {
+        "$or": [
+            {"available_until": {"$lt": threshold}},
+            {"is_deleted": True, "deleted_at": {"$lt": threshold}},
+        ]
+    }
+
+    for tenant in set(CUSTOMERS.values()):
+        db = get_tenant_database(tenant)
+        ensure_archive_indexes(db)
+
+        archived_count = 0
+        with db.client.start_session() as session:
+            while True:
+                projects = session.with_transaction(
+                    lambda session: archive_batch(db, query, session)
+                )
+                if not projects:
+                    break
+                PROJECTS_CACHE.invalidate(
+                    db,
+                    *[project.get("customer_id", "") for project in projects],
+                )
+                archived_count += len(projects)
+
+        print(f"{tenant}: {archived_count} projects archived")
+
+
+def archive_batch(db, query, session):
+    """
+    Move a batch of projects matching query to the archive. Runs in a
+    transaction, a project written concurrently aborts it with a write
+    conflict and the batch is retried with the new state.
+    """
+    projects = list(
+        db[TABLE_NAME].find(query, session=session).limit(ARCHIVE_BATCH_SIZE)
+    )
+    if not projects:
+        return projects
+
+    archived_at = datetime.datetime.now(datetime.timezone.utc)
+    db[ARCHIVE_TABLE_NAME].bulk_write(
+        [
+            pymongo.ReplaceOne(
+                {"_id": project["_id"]},
+                {**project, "archived_at": archived_at},
+                upsert=True,
+            )
+            for project in projects
+        ],
+        ordered=False,
+        session=session,
+    )
+    # archived projects leave the hot collection, delta syncs see them as
+    # deleted through a tombstone
+    db[TOMBSTONE_TABLE_NAME].bulk_write(
+        [
+            pymongo.ReplaceOne(
+                {"_id": project["_id"]},
+                {
+                    "customer_id": project.get("customer_id"),
+                    "deleted_at": project.get("deleted_at") or archived_at,
+                    "updated_at": archived_at,
+                },
+                upsert=True,
+            )
+            for project in projects
+        ],
+        ordered=False,
+        session=session,
+    )
+    db[TABLE_NAME].delete_many(
+        {"_id": {"$in": [project["_id"] for project in projects]}, **query},
+        session=session,
+    )
+    return projects
+
+
+def create_indexes(event, context):
+    """
+    Create the indexes of the handlers on every tenant database. Invoked
+    after each deploy (see the deploy script in package.json), so no
+    request has to create them.
+    """
+    for tenant in set(CUSTOMERS.values()):
+        db = get_tenant_database(tenant)
+        ensure_indexes(db)
+        ensure_archive_indexes(db)
+        print(f"{tenant}: indexes created")
+
+
+def ensure_indexes(db):
+    db[TABLE_NAME].create_index(SYNC_INDEX)
+    db[TOMBSTONE_TABLE_NAME].create_index(SYNC_INDEX)
+    db[TOMBSTONE_TABLE_NAME].create_index(
+        "updated_at", expireAfterSeconds=SYNC_TOMBSTONE_DAYS * 24 * 60 * 60
+    )
+    db[TABLE_NAME].create_index(SUMMARY_INDEX)
+    db[TOKEN_TABLE_NAME].create_index("token", unique=True)
+    # also while PROJECTS_CACHE_STORE is "memory", it can be switched any time
+    MongoStore(CACHE_TABLE_NAME).ensure_index(db)
+    idempotency.ensure_index(db)
+
+
+def ensure_archive_indexes(db):
+    # support both branches of the archive query
+    db[TABLE_NAME].create_index("available_until")
+    db[TABLE_NAME].create_index([("is_deleted", 1), ("deleted_at", 1)])
+
+    collection = db[ARCHIVE_TABLE_NAME]
+    collection.create_index("changes.token")
+    if ARCHIVE_RETENTION_DAYS:
+        collection.create_index(
+            "archived_at",
+            expireAfterSeconds=ARCHIVE_RETENTION_DAYS * 24 * 60 * 60,
+        )
@@ -0,0 +1,105 @@
+"""
+Check that the hot queries of project.py target a single shard once
+jep_tools__customer_project is sharded on customer_id.
+
+    python -m functions.shard_check <tenant> <customer_id>
+
+The queries are explained with a sample project of customer_id, every
+query that reaches more than one shard is reported. The known scatter
+queries (fallbacks that cannot know the customer) are listed as well but
+do not fail the check.
+"""
+
+import sys
+from .project import LEGACY_TOKEN_LOOKUP, TABLE_NAME, TOKEN_TABLE_NAME
+from .utils.database_connection import get_tenant_database
+
+
+def hot_queries(project):
+    """Filters of the hot queries in project.py for project."""
+    customer_id = project.get("customer_id")
+    return {
+        "collection": {"customer_id": customer_id, "is_deleted": False},
+        "sync": {
+            "customer_id": customer_id,
+            "updated_at": {"$gt": project["updated_at"]},
+        },
+        "summary": {"customer_id": customer_id, "is_deleted": False},
+        # also the project lookup of token registry entries and the
+        # update / delete filters
+        "get": {"_id": project["_id"], "customer_id": customer_id},
+        "check_customer_id_match": {
+            "_id": project["_id"],
+            "customer_id": {"$in": [customer_id]},
+        },
+        # guest projects share the "" / null chunks
+        "check_customer_id_match guest": {
+            "_id": project["_id"],
+            "customer_id": {"$in": ["", None]},
+        },
+    }
+
+
+def scatter_queries(project):
+    """Filters of the fallbacks in project.py that reach every shard."""
+    queries = {
+        # registry entries without a customer_id or of a moved project
+        "find_registered_project by _id": {"_id": project["_id"]},
+    }
+    token = project.get("current", {}).get("token")
+    if LEGACY_TOKEN_LOOKUP and token:
+        queries["legacy token lookup"] = {"changes.token": token}
+    return queries
+
+
+def explained_shards(db, collection_name, query):
+    explanation = db.command(
+        "explain",
+        {"find": collection_name, "filter": query},
+        verbosity="queryPlanner",
+    )
+    plan = explanation["queryPlanner"]["winningPlan"]
+    return [shard["shardName"] for shard in plan.get("shards", [])]
+
+
+def check(tenant, customer_id):
+    db = get_tenant_database(tenant)
+    project = db[TABLE_NAME].find_one({"customer_id": customer_id})
+    if not project:
+        print(f"no project of customer {customer_id} found")
+        return False
+
+    queries = [
+        (TABLE_NAME, name, query, False)
+        for name, query in hot_queries(project).items()
+    ]
+    token = project.get("current", {}).get("token")
+    if token:
+        queries.append(
+            (TOKEN_TABLE_NAME, "token lookup", {"token": token}, False)
+        )
+    queries.extend(
+        (TABLE_NAME, name, query, True)
+        for name, query in scatter_queries(project).items()
+    )
+
+    targeted = True
+    for collection_name, name, query, scatter in queries:
+        shards = explained_shards(db, collection_name, query)
+        if not shards:
+            print(f"{name}: {collection_name} is not sharded")
+        elif len(shards) == 1:
+            print(f"{name}: single shard {shards[0]}")
+        elif scatter:
+            print(f"{name}: {len(shards)} shards (known scatter query)")
+        else:
+            print(f"{name}: {len(shards)} shards {', '.join(shards)}")
+            targeted = False
+    return targeted
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3:
+        print(__doc__)
+        sys.exit(2)
+    sys.exit(0 if check(sys.argv[1], sys.argv[2]) else 1)
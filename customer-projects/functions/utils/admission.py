@@ -0,0 +1,96 @@
+import json
+import math
+import os
+import random
+import uuid
+from .rate_limit import ConcurrencyLimiter, LeasedTokenBucket, TokenBucket
+
+
+TABLE_NAME = "jep_tools__rate_limit"
+
+# default limits per tenant, requests per second with a burst capacity
+TENANT_RATE = float(os.environ.get("TENANT_RATE", "50"))
+TENANT_BURST = int(os.environ.get("TENANT_BURST", "100"))
+# concurrent requests per tenant across all containers (0 = unlimited). Unlike
+# the rate limit there is no in-process fast path, every admitted request
+# costs two writes on the primary (take and release its slot).
+TENANT_MAX_CONCURRENCY = int(os.environ.get("TENANT_MAX_CONCURRENCY", "20"))
+# the concurrency slots of a tenant are spread over this many documents, so
+# the two writes of every request do not all hit one document
+TENANT_CONCURRENCY_SHARDS = int(
+    os.environ.get("TENANT_CONCURRENCY_SHARDS", "4")
+)
+# tokens a container takes from the shared bucket at once
+TENANT_LEASE_SIZE = int(os.environ.get("TENANT_LEASE_SIZE", "5"))
+# per tenant overrides, e.g. {"kleineprints": {"rate": 100, "burst": 200}}
+TENANT_LIMITS = json.loads(os.environ.get("TENANT_LIMITS") or "{}")
+
+# slots are released explicitly, the timeout only covers killed invocations
+DEFAULT_SLOT_TIMEOUT_MS = 30 * 1000
+
+# buckets per tenant, they hold the tokens leased by this container
+_BUCKETS = {}
+
+
+def get_limits(tenant):
+    return {
+        "rate": TENANT_RATE,
+        "burst": TENANT_BURST,
+        "max_concurrency": TENANT_MAX_CONCURRENCY,
+        **TENANT_LIMITS.get(tenant, {}),
+    }
+
+
+def admit(db, tenant, context):
+    """
+    Admit a request of tenant before any other database work.
+
+    Returns (slot, None) for admitted requests, the slot has to be passed to
+    release() once the request is done. Rejected requests get
+    (None, retry_after) with retry_after in seconds.
+    """
+    limits = get_limits(tenant)
+    collection = db[TABLE_NAME]
+
+    bucket = _BUCKETS.get(tenant)
+    if bucket is None:
+        bucket = _BUCKETS[tenant] = LeasedTokenBucket(
+            TokenBucket(
+                collection, f"rate:{tenant}", limits["rate"], limits["burst"]
+            ),
+            min(TENANT_LEASE_SIZE, limits["burst"]),
+        )
+    if not bucket.acquire():
+        return None, max(1, math.ceil(1 / limits["rate"]))
+
+    if not limits["max_concurrency"]:
+        return uuid.uuid4().hex, None
+
+    # every shard holds its share of the slots, the shard is part of the
+    # slot so release() finds it again
+    shards = max(1, min(TENANT_CONCURRENCY_SHARDS, limits["max_concurrency"]))
+    shard = random.randrange(shards)
+    slot = f"{shard}:{uuid.uuid4().hex}"
+
+    get_remaining_time = getattr(context, "get_remaining_time_in_millis", None)
+    timeout_ms = (
+        get_remaining_time() if get_remaining_time else DEFAULT_SLOT_TIMEOUT_MS
+    )
+    limiter = ConcurrencyLimiter(
+        collection,
+        f"concurrency:{tenant}:{shard}",
+        math.ceil(limits["max_concurrency"] / shards),
+    )
+    if not limiter.acquire(slot, timeout_ms):
+        return None, 1
+    return slot, None
+
+
+def release(db, tenant, slot):
+    if not get_limits(tenant)["max_concurrency"]:
+        return
+    shard = slot.split(":", 1)[0]
+    limiter = ConcurrencyLimiter(
+        db[TABLE_NAME], f"concurrency:{tenant}:{shard}", 0
+    )
+    limiter.release(slot)
@@ -141,12 +141,18 @@ class LambdaApi:
         # Default values
         content_type = "application/json"
         location = None
+        b64encode = route_entry.b64encode
+        response_headers = None
 
         # Extract optional parameters from the response
         if len(response) > 2:
             content_type = response[2]
         if len(response) > 3:
             location = response[3]
+        if len(response) > 4:
+            b64encode = response[4]
+        if len(response) > 5:
+            response_headers = response[5]
 
         return LambdaResponse.create(
             status=response[1],
@@ -156,9 +162,10 @@ class LambdaApi:
             accepted_methods=[route_entry.method],
             accepted_compression=headers.get("accept-encoding", ""),
             compression=route_entry.compression,
-            b64encode=route_entry.b64encode,
+            b64encode=b64encode,
             ttl=route_entry.ttl,
             location=location,
+            headers=response_headers,
         )
 
     def handle_error(self, error):
@@ -1,23 +1,55 @@
+import json
 import os
 from pymongo.mongo_client import MongoClient
+from pymongo.read_preferences import SecondaryPreferred
 
 
 DB_URI = os.environ.get("TES_DB_URI")
-DB_CONNECTION = MongoClient(DB_URI)
+# connections every client keeps open, opened right away on warm-up
+DB_MIN_POOL_SIZE = int(os.environ.get("TES_DB_MIN_POOL_SIZE", "2"))
+DB_CONNECTION = MongoClient(DB_URI, minPoolSize=DB_MIN_POOL_SIZE)
+
+# tenants served by another cluster than TES_DB_URI, e.g.
+# {"kleineprints": {"uri": "mongodb+srv://...", "db": "kleineprints"}}
+TENANT_CLUSTERS = json.loads(os.environ.get("TES_DB_TENANT_CLUSTERS") or "{}")
+# clients of the tenant clusters by URI, created on first use
+CLUSTER_CONNECTIONS = {}
+
+# MongoDB requires maxStalenessSeconds to be at least 90
+DB_MAX_STALENESS_SECONDS = int(
+    os.environ.get("TES_DB_MAX_STALENESS_SECONDS", "90")
+)
 
 
 def get_connection():
-    global DB_CONNECTION
-    if not connection_is_valid():
-        DB_CONNECTION = MongoClient(DB_URI)
+    # the client reconnects on its own, no ping per call
     return DB_CONNECTION
 
 
-def connection_is_valid():
-    if not DB_CONNECTION:
-        return False
-    try:
-        DB_CONNECTION.server_info()
-        return True
-    except Exception:
-        return False
+def get_cluster_connection(uri=None):
+    """Pooled client of the cluster at uri, the default cluster if None."""
+    if not uri or uri == DB_URI:
+        return get_connection()
+    if uri not in CLUSTER_CONNECTIONS:
+        CLUSTER_CONNECTIONS[uri] = MongoClient(
+            uri, minPoolSize=DB_MIN_POOL_SIZE
+        )
+    return CLUSTER_CONNECTIONS[uri]
+
+
+def get_tenant_database(tenant, default_db=None, read_preference=None):
+    """
+    Database of tenant on its cluster from TENANT_CLUSTERS. Tenants that
+    are not listed use the default cluster and default_db, or their own
+    name as database.
+    """
+    cluster = TENANT_CLUSTERS.get(tenant, {})
+    return get_cluster_connection(cluster.get("uri")).get_database(
+        cluster.get("db", default_db or tenant),
+        read_preference=read_preference,
+    )
+
+
+def secondary_preferred(max_staleness=DB_MAX_STALENESS_SECONDS):
+    """Read preference for read-only handlers that tolerate stale reads."""
+    return SecondaryPreferred(max_staleness=max_staleness)
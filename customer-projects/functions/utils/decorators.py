@@ -1,10 +1,17 @@
+import base64
 import json
 import logging
+import os
+import zlib
 from functools import wraps
 from bson import ObjectId
-from .database_connection import get_connection
+from .database_connection import get_tenant_database
 from .aws_lambda_proxy import LambdaApi
 from .response import APIResponse
+from .deadline import DEADLINE_MARGIN_MS, Deadline, is_timeout
+from .profiling import profiling_requested, run_profiled
+from .warmup import is_provisioned_init, is_warmup, warm_connections
+from . import admission, idempotency
 
 logger = logging.getLogger(__name__)
 CUSTOMERS = {
@@ -14,9 +21,20 @@ CUSTOMERS = {
 
 # Standardized CORS Headers
 CORS_HEADERS = {
-    "Access-Control-Allow-Headers": "Content-Type,X-Amz-Date,Authorization,X-Api-Key,X-Amz-Security-Token,X-Amz-User-Agent"
+    "Access-Control-Allow-Headers": "Content-Type,X-Amz-Date,Authorization,X-Api-Key,X-Amz-Security-Token,X-Amz-User-Agent,Idempotency-Key,X-Export-Key"
 }
 
+# decoded request bodies above this size are rejected with 413
+MAX_BODY_BYTES = int(os.environ.get("REQUEST_MAX_BODY_BYTES", "1048576"))
+
+
+class RequestBodyError(Exception):
+    """Raised while parsing a request body that is rejected by response."""
+
+    def __init__(self, response):
+        super().__init__(response[0])
+        self.response = response
+
 
 # Custom JSON encoder to handle MongoDB ObjectId
 class JSONEncoder(json.JSONEncoder):
@@ -26,22 +44,51 @@ class JSONEncoder(json.JSONEncoder):
         return super(JSONEncoder, self).default(obj)
 
 
-def api(handler):
+def api(handler=None, *, read_preference=None, idempotent=False):
     """
     Decorator for AWS Lambda functions with API Gateway integration.
     - Formats responses in correct API Gateway format using LambdaApi
     - Adds CORS headers
     - Includes error handling
     - Returns proxy integration compatible responses
+
+    Can be used as ``@api`` or ``@api(read_preference=...)``. Handlers
+    without a read preference read from the primary, which is required
+    whenever a handler reads its own writes.
+
+    The handler runs under a Deadline derived from the Lambda remaining
+    time, MongoDB operations that would outlast it are aborted and the
+    request is answered with 503.
+
+    Handlers decorated with ``idempotent=True`` honour an Idempotency-Key
+    header: the response is stored under the key and replayed for retries
+    with the same key without running the handler again.
+
+    Warm-up invocations (scheduled events) do not run the handler. They
+    open the MongoDB pools of all clusters. Containers initialized by
+    provisioned concurrency for the handler warm up at import.
     """
+    if handler is None:
+        return lambda handler: api(
+            handler,
+            read_preference=read_preference,
+            idempotent=idempotent,
+        )
 
     # Create LambdaApi instance for response handling
     lambda_api = LambdaApi("api", debug=True)
 
+    def warm_up():
+        warm_connections()
+
     @wraps(handler)
     def wrapper(event, context):
         logger.debug(f"Event: {event}")
 
+        if is_warmup(event):
+            warm_up()
+            return {"warmup": True}
+
         # Create a mock route entry for use with LambdaApi
         class RouteEntry:
             def __init__(self, method, cors=True):
@@ -51,9 +98,6 @@ def api(handler):
                 self.b64encode = False
                 self.ttl = None
 
-        # Get database connection
-        db_connection = get_connection()
-
         http_method = event.get("httpMethod", "GET")
         headers = event.get("headers", {}) or {}
         headers.update(CORS_HEADERS)  # Apply standard CORS headers
@@ -79,18 +123,96 @@ def api(handler):
                 headers=headers,
             )
 
+        # Fail fast if the invocation is about to time out anyway
+        deadline = Deadline.from_context(context)
+        if deadline.too_short():
+            return lambda_api.process_response(
+                route_entry=route_entry,
+                response=APIResponse.service_unavailable("deadline exceeded"),
+                headers=headers,
+            )
+
+        # Admission control before any other database work
+        tenant_db = get_tenant_database(customer)
+        slot, retry_after = admission.admit(tenant_db, customer, context)
+        if not slot:
+            return lambda_api.process_response(
+                route_entry=route_entry,
+                response=APIResponse.too_many_requests(retry_after),
+                headers=headers,
+            )
+        try:
+            return handle_admitted(
+                event, context, customer, deadline, headers, route_entry
+            )
+        finally:
+            admission.release(tenant_db, customer, slot)
+
+    def handle_admitted(
+        event, context, customer, deadline, headers, route_entry
+    ):
+        http_method = route_entry.method
+
         # Create Request object
-        request = Request(
-            event, context, customer=customer, db=db_connection[customer]
-        )
+        try:
+            request = Request(
+                event,
+                context,
+                customer=customer,
+                db=get_tenant_database(
+                    customer, read_preference=read_preference
+                ),
+                deadline=deadline,
+            )
+        except RequestBodyError as e:
+            return lambda_api.process_response(
+                route_entry=route_entry, response=e.response, headers=headers
+            )
+
+        idempotency_key = None
+        if idempotent:
+            idempotency_key = get_header(headers, "idempotency-key")
+        if idempotency_key:
+            idempotency_key = (
+                f"{http_method}:{event.get('resource')}:{idempotency_key}"
+            )
+            replay = idempotency.begin(
+                request.db,
+                idempotency_key,
+                idempotency.fingerprint(event),
+                # the Lambda remaining time, the claim outlives the handler
+                deadline.remaining() + DEADLINE_MARGIN_MS / 1000,
+            )
+            if replay:
+                return lambda_api.process_response(
+                    route_entry=route_entry, response=replay, headers=headers
+                )
 
         # Execute handler
-        response = handler(request)
+        try:
+            with deadline.apply():
+                response = handler(request)
+        except Exception as e:
+            if idempotency_key:
+                idempotency.release(request.db, idempotency_key)
+            if not is_timeout(e):
+                raise
+            return lambda_api.process_response(
+                route_entry=route_entry,
+                response=APIResponse.service_unavailable("deadline exceeded"),
+                headers=headers,
+            )
+
+        if idempotency_key:
+            if isinstance(response, tuple) and len(response) == 2:
+                idempotency.complete(request.db, idempotency_key, response)
+            else:
+                idempotency.release(request.db, idempotency_key)
 
         # Handle tuple response from APIResponse methods
-        if isinstance(response, tuple) and len(response) == 2:
+        if isinstance(response, tuple) and len(response) >= 2:
             return lambda_api.process_response(
-                route_entry=RouteEntry(method=http_method),
+                route_entry=route_entry,
                 response=response,  # APIResponse already returns properly formatted tuples
                 headers=headers,
             )
@@ -98,17 +220,35 @@ def api(handler):
         # If the handler returned a direct API Gateway response
         return response
 
-    return wrapper
+    @wraps(handler)
+    def profiled_wrapper(event, context):
+        if profiling_requested(event):
+            return run_profiled(wrapper, lambda_api.log, event, context)
+        return wrapper(event, context)
+
+    if is_provisioned_init(handler):
+        warm_up()
+
+    return profiled_wrapper
+
+
+def get_header(headers, name):
+    """Case insensitive header lookup."""
+    for key, value in headers.items():
+        if key.lower() == name:
+            return value
+    return None
 
 
 class Request:
     """Encapsulation of Lambda event and context data."""
 
-    def __init__(self, event, context, customer=None, db=None):
+    def __init__(self, event, context, customer=None, db=None, deadline=None):
         self.event = event
         self.context = context
         self.customer = customer
         self.db = db
+        self.deadline = deadline
         self.method = event.get("httpMethod")
         self.pathParameters = event.get("pathParameters", {}) or {}
         self.queryStringParameters = (
@@ -117,11 +257,47 @@ class Request:
         self.body = self._parse_body(event.get("body"))
 
     def _parse_body(self, body):
-        """Parse request body as JSON."""
+        """
+        Parse request body as JSON, decoding base64 encoded and gzip
+        compressed bodies. Raises RequestBodyError for bodies above
+        MAX_BODY_BYTES (checked before decoding) and malformed bodies.
+        """
         if not body:
             return {}
+
+        headers = {
+            key.lower(): value
+            for key, value in (self.event.get("headers") or {}).items()
+        }
+        is_base64 = self.event.get("isBase64Encoded", False)
+        if is_base64:
+            # 4 base64 characters encode 3 bytes
+            size = len(body) // 4 * 3
+        elif isinstance(body, str):
+            size = len(body.encode())
+        else:
+            size = len(body)
+        if size > MAX_BODY_BYTES:
+            raise RequestBodyError(APIResponse.payload_too_large())
+
         try:
+            if is_base64:
+                body = base64.b64decode(body, validate=True)
+            if headers.get("content-encoding", "").lower() == "gzip":
+                body = self._decompress(body)
             return json.loads(body)
+        except RequestBodyError:
+            raise
         except Exception as e:
             logger.error(f"Error parsing JSON body: {str(e)}")
-            return {}
+            raise RequestBodyError(APIResponse.bad_request("malformed body"))
+
+    def _decompress(self, body):
+        """Decompress a gzip body, stopping once MAX_BODY_BYTES is exceeded."""
+        if isinstance(body, str):
+            body = body.encode("latin-1")
+        decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
+        data = decompressor.decompress(body, MAX_BODY_BYTES + 1)
+        if len(data) > MAX_BODY_BYTES:
+            raise RequestBodyError(APIResponse.payload_too_large())
+        return data
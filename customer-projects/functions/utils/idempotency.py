@@ -0,0 +1,92 @@
+import datetime
+import hashlib
+import os
+from pymongo.errors import DuplicateKeyError
+from .response import APIResponse
+
+
+TABLE_NAME = "jep_tools__idempotency_key"
+# stored responses are replayed for this long
+IDEMPOTENCY_TTL_SECONDS = int(
+    os.environ.get("IDEMPOTENCY_TTL_SECONDS", str(24 * 60 * 60))
+)
+
+
+def fingerprint(event):
+    return hashlib.sha256((event.get("body") or "").encode()).hexdigest()
+
+
+def begin(db, key, body_fingerprint, lease_seconds):
+    """
+    Claim key for the current request for lease_seconds, the time the
+    request can run at most.
+
+    Returns None if the handler should run, otherwise the response to send:
+    the stored response of a completed request, or an error if the key is
+    still in use by a running request or was used for a different body.
+    Claims whose lease expired without a response (e.g. the container was
+    killed) are taken over.
+    """
+    collection = db[TABLE_NAME]
+    now = datetime.datetime.now(datetime.timezone.utc)
+    locked_until = now + datetime.timedelta(seconds=lease_seconds)
+    try:
+        collection.insert_one(
+            {
+                "_id": key,
+                "fingerprint": body_fingerprint,
+                "response": None,
+                "locked_until": locked_until,
+                "created_at": now,
+            }
+        )
+        return None
+    except DuplicateKeyError:
+        existing = collection.find_one({"_id": key})
+
+    if not existing:
+        # expired in the meantime
+        return begin(db, key, body_fingerprint, lease_seconds)
+    if existing["fingerprint"] != body_fingerprint:
+        return APIResponse.bad_request(
+            "Idempotency-Key was already used for a different request"
+        )
+    if existing["response"] is not None:
+        return tuple(existing["response"])
+
+    lease = existing.get("locked_until")
+    if lease is not None and lease.replace(tzinfo=datetime.timezone.utc) > now:
+        return APIResponse.conflict(
+            "a request with this Idempotency-Key is in progress"
+        )
+    # only one of several concurrent retries takes the expired claim over
+    taken_over = collection.update_one(
+        {"_id": key, "response": None, "locked_until": lease},
+        {"$set": {"locked_until": locked_until}},
+    )
+    if taken_over.modified_count == 1:
+        return None
+    return APIResponse.conflict(
+        "a request with this Idempotency-Key is in progress"
+    )
+
+
+def ensure_index(db):
+    """TTL index of the stored responses, created by the deploy step."""
+    db[TABLE_NAME].create_index(
+        "created_at", expireAfterSeconds=IDEMPOTENCY_TTL_SECONDS
+    )
+
+
+def complete(db, key, response):
+    """Store the response of key, server errors release the key instead."""
+    if response[1] >= 500:
+        release(db, key)
+        return
+    db[TABLE_NAME].update_one(
+        {"_id": key}, {"$set": {"response": list(response)}}
+    )
+
+
+def release(db, key):
+    db[TABLE_NAME].delete_one({"_id": key, "response": None})
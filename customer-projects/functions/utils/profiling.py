@@ -0,0 +1,79 @@
+import cProfile
+import hashlib
+import hmac
+import io
+import os
+import pstats
+import resource
+import time
+import tracemalloc
+
+
+# profile every invocation, e.g. while reproducing a slow route on a stage
+PROFILING_ENABLED = os.environ.get("API_PROFILING") == "1"
+# secret for X-Profile-Token headers, profiling per request is off if unset
+PROFILING_SECRET = os.environ.get("API_PROFILING_SECRET")
+PROFILING_TOP_N = int(os.environ.get("API_PROFILING_TOP_N", "20"))
+
+
+def profiling_requested(event):
+    """Check if the invocation should be profiled, cheap when disabled."""
+    if PROFILING_ENABLED:
+        return True
+    if not PROFILING_SECRET:
+        return False
+    headers = event.get("headers") or {}
+    for key, value in headers.items():
+        if key.lower() == "x-profile-token":
+            return token_is_valid(value)
+    return False
+
+
+def create_token(ttl=300):
+    """Token for the X-Profile-Token header, valid for ttl seconds."""
+    expires = str(int(time.time()) + ttl)
+    return f"{expires}.{_sign(expires)}"
+
+
+def token_is_valid(token):
+    expires, _, signature = token.partition(".")
+    if not expires.isdigit() or int(expires) < time.time():
+        return False
+    return hmac.compare_digest(_sign(expires), signature)
+
+
+def _sign(value):
+    return hmac.new(
+        PROFILING_SECRET.encode(), value.encode(), hashlib.sha256
+    ).hexdigest()
+
+
+def run_profiled(func, log, *args):
+    """Run func(*args) under cProfile and tracemalloc and log a report."""
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    tracemalloc.start()
+    profiler = cProfile.Profile()
+    try:
+        return profiler.runcall(func, *args)
+    finally:
+        snapshot = tracemalloc.take_snapshot()
+        _, peak_traced = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+        stats = io.StringIO()
+        pstats.Stats(profiler, stream=stats).sort_stats(
+            "cumulative"
+        ).print_stats(PROFILING_TOP_N)
+        allocations = "\n".join(
+            str(statistic)
+            for statistic in snapshot.statistics("lineno")[:PROFILING_TOP_N]
+        )
+        log.info(
+            f"Profile of {getattr(func, '__name__', func)}\n"
+            # ru_maxrss is in KiB on Linux
+            f"peak RSS delta: {rss_after - rss_before} KiB, "
+            f"peak traced: {peak_traced // 1024} KiB\n"
+            f"{stats.getvalue()}\n"
+            f"Top allocations:\n{allocations}"
+        )
@@ -0,0 +1,150 @@
+import time
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+
+class TokenBucket:
+    """
+    Token bucket shared by all containers, stored in one MongoDB document.
+
+    Refill and take happen in a single atomic pipeline update using the
+    server clock, so concurrent Lambdas never over-spend the bucket.
+    """
+
+    def __init__(self, collection, key, rate, capacity):
+        self.collection = collection
+        self.key = key
+        self.rate = rate
+        self.capacity = capacity
+
+    def _update(self, tokens):
+        elapsed_ms = {
+            "$subtract": ["$$NOW", {"$ifNull": ["$updated_at", "$$NOW"]}]
+        }
+        refilled = {
+            "$min": [
+                self.capacity,
+                {
+                    "$add": [
+                        {"$ifNull": ["$tokens", self.capacity]},
+                        {"$multiply": [elapsed_ms, self.rate / 1000]},
+                    ]
+                },
+            ]
+        }
+        return [
+            {"$set": {"tokens": refilled, "updated_at": "$$NOW"}},
+            {"$set": {"allowed": {"$gte": ["$tokens", tokens]}}},
+            {
+                "$set": {
+                    "tokens": {
+                        "$cond": [
+                            "$allowed",
+                            {"$subtract": ["$tokens", tokens]},
+                            "$tokens",
+                        ]
+                    }
+                }
+            },
+        ]
+
+    def acquire(self, tokens=1):
+        """Take tokens, returns False if the bucket has not enough left."""
+        bucket = self.collection.find_one_and_update(
+            {"_id": self.key},
+            self._update(tokens),
+            upsert=True,
+            return_document=ReturnDocument.AFTER,
+        )
+        return bucket["allowed"]
+
+
+class LeasedTokenBucket:
+    """
+    In-process fast path in front of a shared TokenBucket. Tokens are
+    leased from the shared bucket lease_size at a time and spent locally,
+    so most requests do not touch MongoDB. Leased tokens expire after
+    lease_seconds, idle containers do not hoard capacity.
+    """
+
+    def __init__(self, bucket, lease_size, lease_seconds=1):
+        self.bucket = bucket
+        self.lease_size = lease_size
+        self.lease_seconds = lease_seconds
+        self.tokens = 0
+        self.expires_at = 0
+
+    def acquire(self):
+        if self.tokens > 0 and time.monotonic() < self.expires_at:
+            self.tokens -= 1
+            return True
+
+        if self.lease_size > 1 and self.bucket.acquire(self.lease_size):
+            self.tokens = self.lease_size - 1
+        elif self.bucket.acquire():
+            self.tokens = 0
+        else:
+            return False
+        self.expires_at = time.monotonic() + self.lease_seconds
+        return True
+
+
+class ConcurrencyLimiter:
+    """
+    Caps concurrent requests across all containers. Every running request
+    holds a slot in one MongoDB document. Slots expire on their own, so
+    requests killed by a timeout do not leak capacity.
+    """
+
+    def __init__(self, collection, key, max_concurrency):
+        self.collection = collection
+        self.key = key
+        self.max_concurrency = max_concurrency
+
+    def acquire(self, slot_id, timeout_ms):
+        """Take a slot held for at most timeout_ms, False if all are taken."""
+        live_slots = {
+            "$filter": {
+                "input": {"$ifNull": ["$slots", []]},
+                "cond": {"$gt": ["$$this.expires_at", "$$NOW"]},
+            }
+        }
+        new_slot = {
+            "id": slot_id,
+            "expires_at": {"$add": ["$$NOW", timeout_ms]},
+        }
+        try:
+            limiter = self.collection.find_one_and_update(
+                {"_id": self.key},
+                [
+                    {"$set": {"slots": live_slots}},
+                    {
+                        "$set": {
+                            "slots": {
+                                "$cond": [
+                                    {
+                                        "$lt": [
+                                            {"$size": "$slots"},
+                                            self.max_concurrency,
+                                        ]
+                                    },
+                                    {"$concatArrays": ["$slots", [new_slot]]},
+                                    "$slots",
+                                ]
+                            }
+                        }
+                    },
+                ],
+                projection={"slots.id": 1},
+                upsert=True,
+                return_document=ReturnDocument.AFTER,
+            )
+        except DuplicateKeyError:
+            # concurrent upsert of the first slot, the retry updates
+            return self.acquire(slot_id, timeout_ms)
+        return any(slot["id"] == slot_id for slot in limiter["slots"])
+
+    def release(self, slot_id):
+        self.collection.update_one(
+            {"_id": self.key}, {"$pull": {"slots": {"id": slot_id}}}
+        )
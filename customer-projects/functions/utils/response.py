@@ -36,6 +36,33 @@ class APIResponse:
         APIResponse._track_message(message, detail)
         return json.dumps({"error": message}, default=str), 404
 
+    @staticmethod
+    def conflict(message="conflict", detail=""):
+        APIResponse._track_message(message, detail)
+        return json.dumps({"error": message}, default=str), 409
+
+    @staticmethod
+    def service_unavailable(message="service unavailable", detail=""):
+        APIResponse._track_message(message, detail)
+        return json.dumps({"error": message}, default=str), 503
+
+    @staticmethod
+    def payload_too_large(message="payload too large", detail=""):
+        APIResponse._track_message(message, detail)
+        return json.dumps({"error": message}, default=str), 413
+
+    @staticmethod
+    def too_many_requests(retry_after, message="too many requests"):
+        APIResponse._track_message(message, f"retry after {retry_after}s")
+        return (
+            json.dumps({"error": message}, default=str),
+            429,
+            "application/json",
+            None,
+            False,
+            {"Retry-After": str(retry_after)},
+        )
+
     @staticmethod
     def bad_request(message="bad request", detail=""):
         APIResponse._track_message(message, detail)
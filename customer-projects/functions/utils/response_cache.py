@@ -0,0 +1,113 @@
+import datetime
+import json
+import os
+import time
+from collections import OrderedDict
+from pymongo import ReadPreference
+
+
+CACHE_TTL_SECONDS = int(os.environ.get("RESPONSE_CACHE_TTL_SECONDS", "300"))
+CACHE_MAX_ENTRIES = int(os.environ.get("RESPONSE_CACHE_MAX_ENTRIES", "1000"))
+
+
+class LRUStore:
+    """In-process store, shared by all invocations of a container."""
+
+    def __init__(self, max_entries=CACHE_MAX_ENTRIES, ttl=CACHE_TTL_SECONDS):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()
+
+    def get(self, db, key):
+        entry = self.entries.get(key)
+        if not entry or entry[0] < time.monotonic():
+            return None
+        self.entries.move_to_end(key)
+        return entry[1]
+
+    def set(self, db, key, value):
+        self.entries[key] = (time.monotonic() + self.ttl, value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+
+class MongoStore:
+    """Store shared by all containers, expired by a TTL index."""
+
+    def __init__(self, collection_name, ttl=CACHE_TTL_SECONDS):
+        self.collection_name = collection_name
+        self.ttl = ttl
+
+    def get(self, db, key):
+        entry = db[self.collection_name].find_one({"_id": key})
+        if not entry:
+            return None
+        expires_at = entry["expires_at"].replace(tzinfo=datetime.timezone.utc)
+        if expires_at < datetime.datetime.now(datetime.timezone.utc):
+            return None
+        return entry["value"]
+
+    def ensure_index(self, db):
+        """TTL index, created by the deploy step."""
+        db[self.collection_name].create_index(
+            "expires_at", expireAfterSeconds=0
+        )
+
+    def set(self, db, key, value):
+        db[self.collection_name].replace_one(
+            {"_id": key},
+            {
+                "value": value,
+                "expires_at": datetime.datetime.now(datetime.timezone.utc)
+                + datetime.timedelta(seconds=self.ttl),
+            },
+            upsert=True,
+        )
+
+
+class ResponseCache:
+    """
+    Read-through cache for response bodies, scoped per tenant database and
+    e.g. customer. Each scope has a version counter that writers bump with
+    invalidate(), cache keys include the version so bumping it makes every
+    cached response of the scope unreachable at once.
+    """
+
+    def __init__(self, name, version_collection_name, store):
+        self.name = name
+        self.version_collection_name = version_collection_name
+        self.store = store
+
+    def _version_id(self, scope):
+        return f"{self.name}:{scope}"
+
+    def key(self, db, scope, params):
+        # versions are read from the primary, a stale version would serve
+        # outdated responses after a write
+        version = db.get_collection(
+            self.version_collection_name,
+            read_preference=ReadPreference.PRIMARY,
+        ).find_one({"_id": self._version_id(scope)})
+        return ":".join(
+            [
+                db.name,
+                self._version_id(scope),
+                str(version["version"] if version else 0),
+                json.dumps(params, sort_keys=True),
+            ]
+        )
+
+    def get(self, db, key):
+        return self.store.get(db, key)
+
+    def set(self, db, key, value):
+        self.store.set(db, key, value)
+
+    def invalidate(self, db, *scopes):
+        for scope in set(scopes):
+            db[self.version_collection_name].update_one(
+                {"_id": self._version_id(scope)},
+                {"$inc": {"version": 1}},
+                upsert=True,
+            )
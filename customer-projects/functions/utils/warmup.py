@@ -0,0 +1,43 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+from .database_connection import (
+    DB_MIN_POOL_SIZE,
+    TENANT_CLUSTERS,
+    get_cluster_connection,
+)
+
+
+def is_warmup(event):
+    """
+    Warm-up invocations: scheduled events, configured with
+    ``input: {warmup: true}`` or without input.
+    """
+    return (
+        bool(event.get("warmup"))
+        or event.get("detail-type") == "Scheduled Event"
+    )
+
+
+def is_provisioned_init(handler):
+    """Whether provisioned concurrency initializes a container of handler."""
+    initialization_type = os.environ.get("AWS_LAMBDA_INITIALIZATION_TYPE")
+    if initialization_type != "provisioned-concurrency":
+        return False
+    return os.environ.get("_HANDLER", "").endswith("." + handler.__name__)
+
+
+def cluster_uris():
+    """The default cluster (None) and every tenant cluster."""
+    return {None} | {cluster.get("uri") for cluster in TENANT_CLUSTERS.values()}
+
+
+def open_pool(client, size=DB_MIN_POOL_SIZE):
+    """Open size connections of client with concurrent pings."""
+    size = max(1, size)
+    with ThreadPoolExecutor(max_workers=size) as executor:
+        list(executor.map(lambda _: client.admin.command("ping"), range(size)))
+
+
+def warm_connections():
+    for uri in cluster_uris():
+        open_pool(get_cluster_connection(uri))
@@ -1,7 +1,28 @@
 import os
+import io
+import asyncio
 import datetime
+import hashlib
+import json
+import math
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+import gridfs
+import httpx
 import requests
-from .utils.decorators import api
+from PIL import Image, features
+from .utils.decorators import api, api_async, get_header, DB_NAME
+from .utils.database_connection import (
+    get_async_tenant_database,
+    get_tenant_database,
+    get_tenant_databases,
+    secondary_preferred,
+)
+from .utils.deadline import DeadlineExceeded, deadline_exceeded, http_timeout
+from .utils.http_connection import HTTP_TIMEOUT_SECONDS, get_http_session
+from .utils.rate_limit import CircuitBreaker, TokenBucket
 from .utils.response import APIResponse
 from bson import ObjectId
 import base64
@@ -11,18 +32,204 @@ TABLE_NAMES = {
     "customer": "customer",
     "google_map_static": "google_map_static",
     "google_places": "google_places",
+    "google_place_photos": "google_place_photos",
+    "google_places_refresh": "google_places_refresh",
+    "google_quota": "google_quota",
 }
 
+# most recently refreshed places read on warm-up
+WARMUP_PLACES = int(os.environ.get("WARMUP_PLACES", "200"))
+# connections opened on warm-up, kept alive for the Google calls
+GOOGLE_HOSTS = (
+    "https://places.googleapis.com/",
+    "https://maps.googleapis.com/",
+)
 
-def get_customer(request):
-    return request.db[TABLE_NAMES["customer"]].find_one(
-        {"api_key": request.event["headers"].get("x-api-key")}
+# outbound Google calls shared by all containers
+GOOGLE_MAX_QPS = float(os.environ.get("GOOGLE_MAX_QPS", "10"))
+GOOGLE_BURST = int(os.environ.get("GOOGLE_BURST", "20"))
+GOOGLE_BREAKER_FAILURES = int(os.environ.get("GOOGLE_BREAKER_FAILURES", "5"))
+GOOGLE_BREAKER_RESET_SECONDS = int(
+    os.environ.get("GOOGLE_BREAKER_RESET_SECONDS", "30")
+)
+
+# widths of the resized photo variants, requested widths snap to these
+PHOTO_WIDTHS = [200, 400, 800]
+# width the original photo is fetched from Google with
+PHOTO_MAX_WIDTH = 1600
+# the photos behind /places/{id}/photos/{index} change with the place,
+# clients revalidate with the ETag of the photo variant
+PHOTO_CACHE_CONTROL = "public, max-age=3600"
+
+# static map sizes (smallest first) requested sizes snap to
+STATIC_MAP_SIZES = ["320x240", "480x320", "600x400", "640x640"]
+STATIC_MAP_DEFAULT_SIZE = "600x400"
+# transcoded formats in order of preference, PNG is the fallback
+STATIC_MAP_FORMATS = ["avif", "webp"]
+
+PLACE_MAX_AGE_DAYS = 30
+# places expiring within this many days are refreshed by refresh_places
+REFRESH_AHEAD_DAYS = int(os.environ.get("REFRESH_AHEAD_DAYS", "3"))
+REFRESH_BATCH_SIZE = int(os.environ.get("REFRESH_BATCH_SIZE", "100"))
+REFRESH_WORKERS = int(os.environ.get("REFRESH_WORKERS", "4"))
+REFRESH_MAX_QPS = float(os.environ.get("REFRESH_MAX_QPS", "5"))
+# stop a run early when less than this is left of the Lambda timeout
+REFRESH_STOP_MARGIN_MS = 60 * 1000
+
+# fields of the compact and reviews:N views of a place
+COMPACT_FIELDS = (
+    "place_id",
+    "name",
+    "displayName",
+    "address",
+    "rating",
+    "location",
+)
+COMPACT_REVIEWS = int(os.environ.get("COMPACT_REVIEWS", "3"))
+# view=compact only loads the response body stored on refresh
+COMPACT_BODY_PROJECTION = {
+    "place_id": 1,
+    "customer_id": 1,
+    "updated_at": 1,
+    "compact_body": 1,
+}
+
+# places of one GET /google/places request and how many of them are
+# refreshed from Google at the same time
+BATCH_MAX_IDS = int(os.environ.get("BATCH_MAX_IDS", "20"))
+BATCH_REFRESH_CONCURRENCY = int(
+    os.environ.get("BATCH_REFRESH_CONCURRENCY", "4")
+)
+
+NEARBY_DEFAULT_RADIUS = 5000
+NEARBY_MAX_RADIUS = 50000
+NEARBY_DEFAULT_LIMIT = 20
+NEARBY_MAX_LIMIT = 50
+
+
+class GoogleUnavailable(Exception):
+    """Google is rate limited, failing or the circuit breaker is open."""
+
+
+def warm_google(db):
+    """Warm-up hook of handlers calling Google, opens the connections."""
+    for url in GOOGLE_HOSTS:
+        try:
+            get_http_session().head(url, timeout=HTTP_TIMEOUT_SECONDS)
+        except requests.RequestException:
+            pass
+
+
+async def warm_places(db, http):
+    """
+    Warm-up hook of places: reads the most recently refreshed places into
+    the working set of the database and opens the connection to Google.
+    """
+
+    async def open_google_connection():
+        try:
+            await http.head(GOOGLE_HOSTS[0])
+        except httpx.HTTPError:
+            pass
+
+    await asyncio.gather(
+        db[TABLE_NAMES["google_places"]]
+        .find({})
+        .sort("updated_at", -1)
+        .limit(WARMUP_PLACES)
+        .to_list(),
+        open_google_connection(),
     )
 
 
-def get_place(place_id):
+def google_guards(asynchronous=False):
     """
-    Fetch place details from Google Places API by place_id
+    Quota and circuit breaker of the Google API key. Both are shared by
+    every tenant, so they always live on the default cluster.
+    """
+    get_database = (
+        get_async_tenant_database if asynchronous else get_tenant_database
+    )
+    collection = get_database(None, DB_NAME)[TABLE_NAMES["google_quota"]]
+    return (
+        TokenBucket(collection, "google", GOOGLE_MAX_QPS, GOOGLE_BURST),
+        CircuitBreaker(
+            collection,
+            "google_breaker",
+            GOOGLE_BREAKER_FAILURES,
+            GOOGLE_BREAKER_RESET_SECONDS,
+        ),
+    )
+
+
+def is_unknown_place(error):
+    """Whether Google rejected the place id itself, not the request."""
+    try:
+        status = error.response.json()["error"]["status"]
+    except (ValueError, KeyError, TypeError):
+        return error.response.status_code == 404
+    # INVALID_ARGUMENT is the INVALID_REQUEST of the Places API (New)
+    return status in ("NOT_FOUND", "INVALID_REQUEST", "INVALID_ARGUMENT")
+
+
+def is_google_outage(error):
+    """Errors that count against the circuit breaker."""
+    response = getattr(error, "response", None)
+    if response is not None:
+        return response.status_code == 429 or response.status_code >= 500
+    return isinstance(
+        error,
+        (requests.ConnectionError, requests.Timeout, httpx.TransportError),
+    )
+
+
+def call_google(fetch, *args):
+    """
+    Call fetch(*args) if the shared quota and circuit breaker allow it.
+    Raises GoogleUnavailable instead of calling out or on an outage.
+    """
+    bucket, breaker = google_guards()
+    if breaker.is_open() or not bucket.acquire():
+        raise GoogleUnavailable()
+    try:
+        result = fetch(*args)
+    except Exception as e:
+        if not is_google_outage(e):
+            raise
+        if deadline_exceeded():
+            # cut short by the request deadline, not an outage of Google
+            raise DeadlineExceeded() from e
+        breaker.record_failure()
+        raise GoogleUnavailable() from e
+    breaker.record_success()
+    return result
+
+
+async def call_google_async(fetch, *args):
+    bucket, breaker = google_guards(asynchronous=True)
+    # both checks at once, a token taken while the breaker is open is lost
+    is_open, acquired = await asyncio.gather(
+        breaker.is_open_async(), bucket.acquire_async()
+    )
+    if is_open or not acquired:
+        raise GoogleUnavailable()
+    try:
+        result = await fetch(*args)
+    except Exception as e:
+        if not is_google_outage(e):
+            raise
+        if deadline_exceeded():
+            # cut short by the request deadline, not an outage of Google
+            raise DeadlineExceeded() from e
+        await breaker.record_failure_async()
+        raise GoogleUnavailable() from e
+    await breaker.record_success_async()
+    return result
+
+
+def place_details_request(place_id):
+    """
+    Build url and params for the Google Places API Place Details endpoint
     """
     api_key = os.environ.get("GOOGLE_API_KEY")
 
@@ -47,95 +254,352 @@ def get_place(place_id):
         "key": api_key,
         "fields": ",".join(fields),
     }
+    return url, params
+
 
-    response = requests.get(url, params=params)
+def get_place(place_id):
+    """
+    Fetch place details from Google Places API by place_id
+    """
+    url, params = place_details_request(place_id)
+
+    response = get_http_session().get(
+        url, params=params, timeout=http_timeout(HTTP_TIMEOUT_SECONDS)
+    )
     response.raise_for_status()
 
     return response.json()
 
 
-@api
-def places(request):
-    customer = get_customer(request)
-    if not customer:
-        return APIResponse.not_authorized()
+async def get_place_async(http, place_id):
+    """
+    Fetch place details from Google Places API by place_id
+    """
+    url, params = place_details_request(place_id)
+
+    response = await http.get(
+        url, params=params, timeout=http_timeout(HTTP_TIMEOUT_SECONDS)
+    )
+    response.raise_for_status()
+
+    return response.json()
+
+
+def place_needs_update(place):
+    # If place doesn't exist or needs updating
+    if not place:
+        return True
+    if not place.get("updated_at"):
+        return False
+
+    updated_at = place["updated_at"]
+    current_time = datetime.datetime.now(datetime.timezone.utc)
+
+    # Fix the datetime comparison by ensuring both are timezone-aware
+    if isinstance(updated_at, datetime.datetime) and updated_at.tzinfo is None:
+        # Convert naive datetime to aware datetime with UTC timezone
+        updated_at = updated_at.replace(tzinfo=datetime.timezone.utc)
+
+    # Now compare the datetimes (both timezone-aware)
+    return updated_at < current_time - datetime.timedelta(
+        days=PLACE_MAX_AGE_DAYS
+    )
+
+
+def apply_place_data(place, place_data, place_id, customer_id):
+    """Merge fresh Google data into the cached place document."""
+    # Prepare document for db
+    if not place:
+        place = {
+            "place_id": place_id,
+            "customer_id": customer_id,
+            "created_at": datetime.datetime.now(datetime.timezone.utc),
+        }
+
+    place.update(
+        {
+            "name": place_data.get("name"),
+            "displayName": place_data.get("displayName"),
+            "address": place_data.get("formattedAddress"),
+            "rating": place_data.get("rating"),
+            "reviews": place_data.get("reviews"),
+            "photos": place_data.get("photos"),
+            "location": place_data.get("location"),
+            "geo": location_to_geo(place_data.get("location")),
+            "updated_at": datetime.datetime.now(datetime.timezone.utc),
+        }
+    )
+    place["compact_body"] = compact_body(place)
+    return place
+
 
+def parse_place_view(view):
+    """
+    Reviews returned for a view= parameter, None for the full document.
+    Raises ValueError for unknown views.
+    """
+    if view == "full":
+        return None
+    if view == "compact":
+        return COMPACT_REVIEWS
+    name, _, count = view.partition(":")
+    if name == "reviews" and count.isdigit():
+        return int(count)
+    raise ValueError(view)
+
+
+def place_view_projection(reviews):
+    """Projection loading what a view with reviews reviews returns."""
+    if reviews is None:
+        return {"compact_body": 0}
+    return {
+        "customer_id": 1,
+        "updated_at": 1,
+        **{field: 1 for field in COMPACT_FIELDS},
+        "reviews": {"$slice": reviews},
+    }
+
+
+def place_view(place, reviews):
+    """Place of a view response, from the full or the projected document."""
+    if reviews is None:
+        return clean_place(place)
+    return {
+        **{field: place.get(field) for field in COMPACT_FIELDS},
+        "reviews": (place.get("reviews") or [])[:reviews],
+    }
+
+
+def compact_body(place):
+    """Serialized compact response, stored with the place on refresh."""
+    return json.dumps(
+        {"place": place_view(place, COMPACT_REVIEWS)}, default=str
+    )
+
+
+async def place_view_response(collection, place, view, reviews):
+    if view != "compact":
+        return APIResponse.ok({"place": place_view(place, reviews)})
+    if "compact_body" not in place:
+        # cached before compact bodies were stored
+        place = await collection.find_one(
+            {"_id": place["_id"]}, place_view_projection(COMPACT_REVIEWS)
+        )
+        place["compact_body"] = compact_body(place)
+        await collection.update_one(
+            {"_id": place["_id"]},
+            {"$set": {"compact_body": place["compact_body"]}},
+        )
+    return place["compact_body"], 200
+
+
+def location_to_geo(location):
+    """GeoJSON point of a Google location, used by the 2dsphere index."""
+    if not location or "latitude" not in location:
+        return None
+    return {
+        "type": "Point",
+        "coordinates": [location["longitude"], location["latitude"]],
+    }
+
+
+def clean_place(place):
+    # Clean the response before returning
+    if "_id" in place and isinstance(place["_id"], ObjectId):
+        place["_id"] = str(place["_id"])
+    if "customer_id" in place and isinstance(place["customer_id"], ObjectId):
+        place["customer_id"] = str(place["customer_id"])
+    place.pop("compact_body", None)
+    return place
+
+
+@api_async(warmup=warm_places)
+async def places(request):
     # find places by code and customer_id
     place_id = request.pathParameters.get("id")
     if not place_id:
         return APIResponse.bad_request("code is required")
-    place = request.db[TABLE_NAMES["google_places"]].find_one(
-        {"place_id": place_id, "customer_id": customer["_id"]},
+
+    # compact is served from the body stored on refresh, reviews:N and
+    # full are projected from the document
+    view = request.queryStringParameters.get("view", "full")
+    try:
+        reviews = parse_place_view(view)
+    except ValueError:
+        return APIResponse.bad_request(
+            "view must be compact, reviews:N or full"
+        )
+    if view == "compact":
+        projection = COMPACT_BODY_PROJECTION
+    else:
+        projection = place_view_projection(reviews)
+    collection = request.db[TABLE_NAMES["google_places"]]
+
+    # only the place of the customer is loaded
+    customer = request.customer
+
+    place = await collection.find_one(
+        {"place_id": place_id, "customer_id": customer["_id"]}, projection
+    )
+    return await load_place_view(
+        request, collection, customer, place_id, place, view, reviews
     )
 
-    should_update = False
-    # If place doesn't exist or needs updating
-    if not place:
-        should_update = True
-    elif place.get("updated_at"):
-        updated_at = place["updated_at"]
-        current_time = datetime.datetime.now(datetime.timezone.utc)
-
-        # Fix the datetime comparison by ensuring both are timezone-aware
-        if (
-            isinstance(updated_at, datetime.datetime)
-            and updated_at.tzinfo is None
-        ):
-            # Convert naive datetime to aware datetime with UTC timezone
-            updated_at = updated_at.replace(tzinfo=datetime.timezone.utc)
 
-        # Now compare the datetimes (both timezone-aware)
-        if updated_at < current_time - datetime.timedelta(days=30):
-            should_update = True
+@api_async(warmup=warm_places)
+async def places_batch(request):
+    """
+    Several places of the customer in one request, ids=a,b,c. The cached
+    places are loaded with one query, missing and stale places are
+    refreshed concurrently. Every id gets its own result, a place or an
+    error.
+    """
+    ids = request.queryStringParameters.get("ids", "")
+    # unique ids in request order
+    place_ids = list(
+        dict.fromkeys(filter(None, (id.strip() for id in ids.split(","))))
+    )
+    if not place_ids:
+        return APIResponse.bad_request("ids is required")
+    if len(place_ids) > BATCH_MAX_IDS:
+        return APIResponse.bad_request(f"at most {BATCH_MAX_IDS} ids")
 
-    if should_update:
-        # Get fresh data from Google API
-        place_data = get_place(place_id)
-
-        # Prepare document for db
-        if not place:
-            place = {
-                "place_id": place_id,
-                "customer_id": customer["_id"],
-                "created_at": datetime.datetime.now(datetime.timezone.utc),
-            }
+    view = request.queryStringParameters.get("view", "full")
+    try:
+        reviews = parse_place_view(view)
+    except ValueError:
+        return APIResponse.bad_request(
+            "view must be compact, reviews:N or full"
+        )
+    if view == "compact":
+        projection = COMPACT_BODY_PROJECTION
+    else:
+        projection = place_view_projection(reviews)
+    collection = request.db[TABLE_NAMES["google_places"]]
 
-        place.update(
-            {
-                "name": place_data.get("name"),
-                "displayName": place_data.get("displayName"),
-                "address": place_data.get("formattedAddress"),
-                "rating": place_data.get("rating"),
-                "reviews": place_data.get("reviews"),
-                "photos": place_data.get("photos"),
-                "location": place_data.get("location"),
-                "updated_at": datetime.datetime.now(datetime.timezone.utc),
-            }
+    customer = request.customer
+
+    places_by_id = {
+        place["place_id"]: place
+        async for place in collection.find(
+            {"place_id": {"$in": place_ids}, "customer_id": customer["_id"]},
+            projection,
         )
+    }
+
+    refresh_slots = asyncio.Semaphore(BATCH_REFRESH_CONCURRENCY)
+
+    async def load(place_id):
+        place = places_by_id.get(place_id)
+        # only refreshes from Google take one of the slots
+        slot = refresh_slots if place_needs_update(place) else nullcontext()
+        try:
+            async with slot:
+                body, _ = await load_place_view(
+                    request,
+                    collection,
+                    customer,
+                    place_id,
+                    place,
+                    view,
+                    reviews,
+                )
+        except httpx.HTTPStatusError as error:
+            if is_unknown_place(error):
+                body, _ = APIResponse.not_found("place not found")
+            else:
+                body, _ = APIResponse.bad_gateway(
+                    "google request failed", str(error)
+                )
+        return body
+
+    # the bodies are serialized already, stored compact bodies included
+    bodies = await asyncio.gather(*(load(place_id) for place_id in place_ids))
+    return (
+        '{"places": {'
+        + ", ".join(
+            f"{json.dumps(place_id)}: {body}"
+            for place_id, body in zip(place_ids, bodies)
+        )
+        + "}}",
+        200,
+    )
+
+
+async def load_place_view(
+    request, collection, customer, place_id, place, view, reviews
+):
+    """
+    View response of place_id for customer. Missing and stale places are
+    fetched from Google first, a stale place is served while Google is
+    unavailable.
+    """
+    if place_needs_update(place):
+        # Get fresh data from Google API
+        try:
+            place_data = await call_google_async(
+                get_place_async, request.http, place_id
+            )
+        except GoogleUnavailable:
+            if not place:
+                return APIResponse.service_unavailable()
+            # serve the stale document until Google is available again
+            return await place_view_response(collection, place, view, reviews)
+        place = apply_place_data(place, place_data, place_id, customer["_id"])
 
         # Insert or update in database
         if "_id" in place:
-            request.db[TABLE_NAMES["google_places"]].update_one(
-                {"_id": place["_id"]}, {"$set": place}
-            )
+            await collection.update_one({"_id": place["_id"]}, {"$set": place})
         else:
-            result = request.db[TABLE_NAMES["google_places"]].insert_one(place)
+            result = await collection.insert_one(place)
             place["_id"] = result.inserted_id
 
-    # Clean the response before returning
-    if "_id" in place and isinstance(place["_id"], ObjectId):
-        place["_id"] = str(place["_id"])
-    if "customer_id" in place and isinstance(place["customer_id"], ObjectId):
-        place["customer_id"] = str(place["customer_id"])
+    return await place_view_response(collection, place, view, reviews)
+
+
+@api(read_preference=secondary_preferred())
+def nearby_places(request):
+    customer = request.customer
 
-    return APIResponse.ok({"place": place})
+    params = request.queryStringParameters
+    try:
+        lat = float(params["lat"])
+        lng = float(params["lng"])
+        radius = float(params.get("radius", NEARBY_DEFAULT_RADIUS))
+        limit = int(params.get("limit", NEARBY_DEFAULT_LIMIT))
+    except (KeyError, ValueError):
+        return APIResponse.bad_request("lat and lng are required numbers")
+    if not (-90 <= lat <= 90 and -180 <= lng <= 180):
+        return APIResponse.bad_request("lat or lng out of range")
+    # NaN and inf pass float(), and NaN slips through min()
+    if not (math.isfinite(radius) and radius > 0):
+        return APIResponse.bad_request("radius must be a positive number")
+    radius = min(radius, NEARBY_MAX_RADIUS)
 
+    # answered from the cache only, no Google calls
+    places = request.db[TABLE_NAMES["google_places"]].aggregate(
+        [
+            {
+                "$geoNear": {
+                    "near": {"type": "Point", "coordinates": [lng, lat]},
+                    "key": "geo",
+                    "distanceField": "distance",
+                    "maxDistance": radius,
+                    "query": {"customer_id": customer["_id"]},
+                    "spherical": True,
+                }
+            },
+            {"$limit": max(1, min(limit, NEARBY_MAX_LIMIT))},
+            {"$project": {"compact_body": 0}},
+        ]
+    )
 
-@api
+    return APIResponse.ok({"places": [clean_place(place) for place in places]})
+
+
+@api(read_preference=secondary_preferred(), warmup=warm_google)
 def static_map(request):
-    customer = get_customer(request)
-    if not customer:
-        return APIResponse.not_authorized()
+    customer = request.customer
 
     # find places by code and customer_id
     place_id = request.pathParameters.get("place_id")
@@ -149,32 +613,419 @@ def static_map(request):
     if not place:
         return APIResponse.not_found("Place not found")
 
-    # Clean the response before returning
-    if "_id" in place and isinstance(place["_id"], ObjectId):
-        place["_id"] = str(place["_id"])
-    if "customer_id" in place and isinstance(place["customer_id"], ObjectId):
-        place["customer_id"] = str(place["customer_id"])
+    size = normalize_static_map_size(request.queryStringParameters.get("size"))
+    scale = 2 if request.queryStringParameters.get("scale") == "2" else 1
+    image_format = negotiate_image_format(
+        get_header(request.event["headers"], "accept") or ""
+    )
 
+    try:
+        content, image_format = get_static_map(
+            request.db, place, size, scale, image_format
+        )
+    except GoogleUnavailable:
+        return APIResponse.service_unavailable()
+
+    # also on stale fallbacks, the format depends on Accept either way
+    return (
+        content,
+        200,
+        f"image/{image_format}",
+        None,
+        True,
+        {"Vary": "Accept"},
+    )
+
+
+def normalize_static_map_size(size):
+    """Snap a requested WxH size to the smallest cached size that fits it."""
+    try:
+        width, height = (int(value) for value in size.split("x"))
+    except (AttributeError, ValueError):
+        return STATIC_MAP_DEFAULT_SIZE
+    for static_map_size in STATIC_MAP_SIZES:
+        max_width, max_height = (int(v) for v in static_map_size.split("x"))
+        if width <= max_width and height <= max_height:
+            return static_map_size
+    return STATIC_MAP_SIZES[-1]
+
+
+def accepted_media_types(accept):
+    """Media types of an Accept header, without the ones refused by q=0."""
+    media_types = set()
+    for media_range in accept.split(","):
+        media_type, *params = media_range.split(";")
+        quality = 1.0
+        for param in params:
+            name, _, value = param.partition("=")
+            if name.strip().lower() == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        if quality > 0:
+            media_types.add(media_type.strip().lower())
+    return media_types
+
+
+def negotiate_image_format(accept):
+    media_types = accepted_media_types(accept)
+    for image_format in STATIC_MAP_FORMATS:
+        if f"image/{image_format}" in media_types and features.check(
+            image_format
+        ):
+            return image_format
+    return "png"
+
+
+def transcode_image(content, image_format):
+    image = Image.open(io.BytesIO(content))
+    output = io.BytesIO()
+    image.save(output, image_format.upper(), quality=80)
+    return output.getvalue()
+
+
+def static_map_url(place, size=STATIC_MAP_DEFAULT_SIZE, scale=1):
     # Office location for Dr. Seegers practice (adjust as needed)
     center = f"{place['location'].get('latitude', 0)},{place['location'].get('longitude', 0)}"
     zoom = "15"
-    size = "600x400"
     markers = f"color:red|{center}"
 
     # Construct the Google Maps Static API URL
     api_key = os.environ.get("GOOGLE_API_KEY")
-    url = f"https://maps.googleapis.com/maps/api/staticmap?center={center}&zoom={zoom}&size={size}&markers={markers}&key={api_key}"
+    return f"https://maps.googleapis.com/maps/api/staticmap?center={center}&zoom={zoom}&size={size}&scale={scale}&markers={markers}&key={api_key}"
 
-    print(f"Google Maps URL: {url}")
+
+def fetch_static_map(place, size, scale):
     # Make the request to Google Maps API
-    response = requests.get(url, stream=True)
+    response = get_http_session().get(
+        static_map_url(place, size, scale),
+        stream=True,
+        timeout=http_timeout(HTTP_TIMEOUT_SECONDS),
+    )
 
     response.raise_for_status()
 
-    return (
-        response.content,
-        200,
-        "image/png",
-        None,
-        True,
+    return response.content
+
+
+def store_static_map(db, place, size, scale, image_format, content):
+    db[TABLE_NAMES["google_map_static"]].update_one(
+        {
+            "place": place["_id"],
+            "size": size,
+            "scale": scale,
+            "format": image_format,
+        },
+        {
+            "$set": {
+                "location": place["location"],
+                "content": content,
+                "updated_at": datetime.datetime.now(datetime.timezone.utc),
+            }
+        },
+        upsert=True,
+    )
+
+
+def render_static_map(db, place, size=STATIC_MAP_DEFAULT_SIZE, scale=1):
+    """Fetch the static map of a place from Google and cache it."""
+    content = call_google(fetch_static_map, place, size, scale)
+    store_static_map(db, place, size, scale, "png", content)
+    return content
+
+
+def get_static_map(db, place, size, scale, image_format):
+    """
+    Load a static map variant from the cache. Maps are fetched from Google
+    as PNG once and transcoded into other formats on first access.
+    Returns the content and its format.
+    """
+    variant = {"place": place["_id"], "size": size, "scale": scale}
+    cached_maps = {
+        cached["format"]: cached["content"]
+        for cached in db[TABLE_NAMES["google_map_static"]].find(
+            {
+                **variant,
+                "format": {"$in": [image_format, "png"]},
+                "location": place["location"],
+            }
+        )
+    }
+    if image_format in cached_maps:
+        return cached_maps[image_format], image_format
+
+    png = cached_maps.get("png")
+    if png is None:
+        try:
+            png = render_static_map(db, place, size, scale)
+        except GoogleUnavailable:
+            # fall back to a map rendered for an older location of the place,
+            # in a format the client accepts (PNG is the default of all)
+            stale_maps = {
+                stale.get("format", "png"): stale["content"]
+                for stale in db[TABLE_NAMES["google_map_static"]].find(
+                    {**variant, "format": {"$in": [image_format, "png"]}}
+                )
+            }
+            for stale_format in (image_format, "png"):
+                if stale_format in stale_maps:
+                    return stale_maps[stale_format], stale_format
+            raise
+
+    if image_format == "png":
+        return png, "png"
+    content = transcode_image(png, image_format)
+    store_static_map(db, place, size, scale, image_format, content)
+    return content, image_format
+
+
+def get_place_photo_media(photo_name):
+    """
+    Fetch the media of a place photo from Google Places API
+    """
+    api_key = os.environ.get("GOOGLE_API_KEY")
+
+    if not api_key:
+        raise ValueError(
+            "Missing required environment variables: GOOGLE_API_KEY"
+        )
+
+    url = f"https://places.googleapis.com/v1/{photo_name}/media"
+    params = {
+        "key": api_key,
+        "maxWidthPx": PHOTO_MAX_WIDTH,
+    }
+
+    response = get_http_session().get(
+        url, params=params, timeout=http_timeout(HTTP_TIMEOUT_SECONDS)
+    )
+    response.raise_for_status()
+
+    return response.content, response.headers.get("Content-Type", "image/jpeg")
+
+
+def normalize_photo_width(width):
+    """Snap a requested width to the next cached variant, None = original."""
+    if not width or not width.isdigit():
+        return None
+    for photo_width in PHOTO_WIDTHS:
+        if int(width) <= photo_width:
+            return photo_width
+    return None
+
+
+def resize_photo(content, width):
+    image = Image.open(io.BytesIO(content))
+    image.thumbnail((width, width * 4))
+    output = io.BytesIO()
+    image.convert("RGB").save(output, "JPEG", quality=80, optimize=True)
+    return output.getvalue(), "image/jpeg"
+
+
+def get_cached_photo(db, fs, photo_name, width):
+    """Load a photo variant from GridFS, creating it on first access."""
+    filename = f"{photo_name}/{width or 'original'}"
+    cached = fs.find_one({"filename": filename})
+    if cached:
+        return cached.read(), cached.metadata["content_type"]
+
+    if width:
+        original, _ = get_cached_photo(db, fs, photo_name, None)
+        content, content_type = resize_photo(original, width)
+    else:
+        content, content_type = call_google(get_place_photo_media, photo_name)
+
+    fs.put(
+        content,
+        filename=filename,
+        metadata={"content_type": content_type},
+    )
+    return content, content_type
+
+
+@api(warmup=warm_google)
+def place_photo(request):
+    customer = request.customer
+
+    place_id = request.pathParameters.get("id")
+    if not place_id:
+        return APIResponse.bad_request("code is required")
+    index = request.pathParameters.get("index", "")
+    if not index.isdigit():
+        return APIResponse.bad_request("index must be a number")
+
+    place = request.db[TABLE_NAMES["google_places"]].find_one(
+        {"place_id": place_id, "customer_id": customer["_id"]},
+        {"photos": 1},
+    )
+    if not place:
+        return APIResponse.not_found("Place not found")
+
+    photos = place.get("photos") or []
+    if int(index) >= len(photos):
+        return APIResponse.not_found("Photo not found")
+
+    photo_name = photos[int(index)]["name"]
+    width = normalize_photo_width(request.queryStringParameters.get("width"))
+    # photo names are unique per photo, the variant is never rewritten
+    etag = '"{}"'.format(
+        hashlib.sha256(f"{photo_name}/{width}".encode()).hexdigest()[:32]
+    )
+    headers = {"Cache-Control": PHOTO_CACHE_CONTROL, "ETag": etag}
+    if get_header(request.event["headers"], "if-none-match") == etag:
+        return "", 304, None, None, False, headers
+
+    fs = gridfs.GridFS(
+        request.db, collection=TABLE_NAMES["google_place_photos"]
+    )
+    try:
+        content, content_type = get_cached_photo(
+            request.db, fs, photo_name, width
+        )
+    except GoogleUnavailable:
+        return APIResponse.service_unavailable()
+
+    return content, 200, content_type, None, True, headers
+
+
+class QpsLimiter:
+    """Spaces calls of all threads to at most max_qps per second."""
+
+    def __init__(self, max_qps):
+        self.interval = 1 / max_qps
+        self.next_call = time.monotonic()
+        self.lock = threading.Lock()
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            wait_until = max(self.next_call, now)
+            self.next_call = wait_until + self.interval
+        time.sleep(max(0, wait_until - now))
+
+
+def refresh_place(db, place, limiter):
+    limiter.wait()
+    place_data = call_google(get_place, place["place_id"])
+    place = apply_place_data(
+        place, place_data, place["place_id"], place["customer_id"]
+    )
+    db[TABLE_NAMES["google_places"]].update_one(
+        {"_id": place["_id"]}, {"$set": place}
+    )
+    if place.get("location"):
+        limiter.wait()
+        render_static_map(db, place)
+
+
+def create_indexes(event, context):
+    """
+    Create the indexes of the handlers on the default database and every
+    tenant cluster database. Invoked after each deploy (see the deploy
+    script in package.json), so no request has to create them.
+    """
+    for db in get_tenant_databases(DB_NAME):
+        db[TABLE_NAMES["google_places"]].create_index(
+            [("geo", "2dsphere"), ("customer_id", 1)]
+        )
+        print(f"{db.name}: indexes created")
+
+
+def refresh_places(event, context):
+    """
+    Scheduled job refreshing places (and their static maps) that are about
+    to expire, on the default cluster and every tenant cluster. Progress is
+    checkpointed after every batch so a run that is stopped before the
+    Lambda timeout resumes where it left off.
+    """
+    for db in get_tenant_databases(DB_NAME):
+        if not refresh_database_places(db, context):
+            break
+
+
+def refresh_database_places(db, context):
+    """Refresh the places of db, returns True once all were refreshed."""
+    checkpoints = db[TABLE_NAMES["google_places_refresh"]]
+
+    # places cached before GeoJSON points were stored
+    db[TABLE_NAMES["google_places"]].update_many(
+        {"geo": {"$exists": False}, "location.latitude": {"$exists": True}},
+        [
+            {
+                "$set": {
+                    "geo": {
+                        "type": "Point",
+                        "coordinates": [
+                            "$location.longitude",
+                            "$location.latitude",
+                        ],
+                    }
+                }
+            }
+        ],
+    )
+
+    checkpoint = checkpoints.find_one({"_id": "refresh_places"})
+    if not checkpoint or checkpoint.get("finished_at"):
+        checkpoint = {
+            "_id": "refresh_places",
+            "cutoff": datetime.datetime.now(datetime.timezone.utc)
+            - datetime.timedelta(days=PLACE_MAX_AGE_DAYS - REFRESH_AHEAD_DAYS),
+            "last_id": None,
+            "refreshed": 0,
+            "failed": 0,
+            "started_at": datetime.datetime.now(datetime.timezone.utc),
+            "finished_at": None,
+        }
+        checkpoints.replace_one(
+            {"_id": "refresh_places"}, checkpoint, upsert=True
+        )
+
+    limiter = QpsLimiter(REFRESH_MAX_QPS)
+    with ThreadPoolExecutor(max_workers=REFRESH_WORKERS) as executor:
+        while context.get_remaining_time_in_millis() > REFRESH_STOP_MARGIN_MS:
+            query = {"updated_at": {"$lt": checkpoint["cutoff"]}}
+            if checkpoint["last_id"]:
+                query["_id"] = {"$gt": checkpoint["last_id"]}
+            batch = list(
+                db[TABLE_NAMES["google_places"]]
+                .find(query)
+                .sort("_id", 1)
+                .limit(REFRESH_BATCH_SIZE)
+            )
+            if not batch:
+                checkpoint["finished_at"] = datetime.datetime.now(
+                    datetime.timezone.utc
+                )
+                break
+
+            futures = [
+                executor.submit(refresh_place, db, place, limiter)
+                for place in batch
+            ]
+            unavailable = False
+            for place, future in zip(batch, futures):
+                try:
+                    future.result()
+                    checkpoint["refreshed"] += 1
+                except GoogleUnavailable:
+                    unavailable = True
+                except Exception as e:
+                    print(f"refresh of place {place['_id']} failed: {e}")
+                    checkpoint["failed"] += 1
+
+            # keep the checkpoint so the next run retries this batch
+            if unavailable:
+                print("Google unavailable, stopping refresh")
+                break
+
+            checkpoint["last_id"] = batch[-1]["_id"]
+            checkpoints.replace_one({"_id": "refresh_places"}, checkpoint)
+
+    checkpoints.replace_one({"_id": "refresh_places"}, checkpoint)
+    print(
+        f"{checkpoint['refreshed']} places refreshed, "
+        f"{checkpoint['failed']} failed"
     )
+    return checkpoint["finished_at"] is not None
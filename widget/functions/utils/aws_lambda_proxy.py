@@ -19,13 +19,14 @@ class LambdaResponse:
         "image/jpg",
         "image/tiff",
         "image/webp",
+        "image/avif",
         "image/jp2",
     ]
 
     @staticmethod
     def create(
         status: int,
-        content_type: str,
+        content_type: Optional[str],
         body: Any,
         cors: bool = True,
         accepted_methods: List[str] = ["GET"],
@@ -38,7 +39,10 @@ class LambdaResponse:
     ) -> Dict[str, Any]:
         """Creates a formatted Lambda response"""
 
-        response_headers = {"Content-Type": content_type}
+        # no Content-Type for bodyless responses, e.g. 304
+        response_headers = (
+            {"Content-Type": content_type} if content_type else {}
+        )
 
         # Add CORS headers
         if cors:
@@ -142,6 +146,7 @@ class LambdaApi:
         content_type = "application/json"
         location = None
         b64encode = False
+        response_headers = None
 
         # Extract optional parameters from the response
         if len(response) > 2:
@@ -150,6 +155,8 @@ class LambdaApi:
             location = response[3]
         if len(response) > 4:
             b64encode = response[4]
+        if len(response) > 5:
+            response_headers = response[5]
 
         return LambdaResponse.create(
             status=response[1],
@@ -162,6 +169,7 @@ class LambdaApi:
             b64encode=b64encode,
             ttl=route_entry.ttl,
             location=location,
+            headers=response_headers,
         )
 
     def handle_error(self, error):
@@ -0,0 +1,64 @@
+import os
+import time
+
+
+TABLE_NAME = "customer"
+# customers resolved by api key are kept per container for this long
+CUSTOMER_CACHE_SECONDS = int(os.environ.get("CUSTOMER_CACHE_SECONDS", "60"))
+
+# customers by api key with the time they expire, see find_customer
+_CUSTOMERS = {}
+
+
+def find_customer(db, api_key):
+    """
+    Customer of the api key, cached for CUSTOMER_CACHE_SECONDS. Unknown
+    keys are not cached, so random keys do not grow the cache.
+    """
+    if not api_key:
+        return None
+    customer = cached_customer(api_key)
+    if customer is None:
+        customer = db[TABLE_NAME].find_one({"api_key": api_key})
+        if customer:
+            cache_customer(customer)
+    return customer
+
+
+async def find_customer_async(db, api_key):
+    if not api_key:
+        return None
+    customer = cached_customer(api_key)
+    if customer is None:
+        customer = await db[TABLE_NAME].find_one({"api_key": api_key})
+        if customer:
+            cache_customer(customer)
+    return customer
+
+
+def cached_customer(api_key):
+    cached = _CUSTOMERS.get(api_key)
+    if cached and cached[1] > time.monotonic():
+        return cached[0]
+    return None
+
+
+def cache_customer(customer):
+    _CUSTOMERS[customer.get("api_key")] = (
+        customer,
+        time.monotonic() + CUSTOMER_CACHE_SECONDS,
+    )
+
+
+def warm_customers(db):
+    """Warm-up hook resolving all api keys into the customer cache."""
+    for customer in db[TABLE_NAME].find({"api_key": {"$exists": True}}):
+        cache_customer(customer)
+
+
+async def warm_customers_async(db):
+    customers = (
+        await db[TABLE_NAME].find({"api_key": {"$exists": True}}).to_list()
+    )
+    for customer in customers:
+        cache_customer(customer)
@@ -1,23 +1,102 @@
+import json
 import os
+from pymongo import AsyncMongoClient
 from pymongo.mongo_client import MongoClient
+from pymongo.read_preferences import SecondaryPreferred
 
 
 DB_URI = os.environ.get("TES_DB_URI")
-DB_CONNECTION = MongoClient(DB_URI)
+# connections every client keeps open, opened right away on warm-up
+DB_MIN_POOL_SIZE = int(os.environ.get("TES_DB_MIN_POOL_SIZE", "2"))
+# both created on first use, so api_async containers open no sync pool
+DB_CONNECTION = None
+# created lazily inside the event loop of the api_async decorator
+ASYNC_DB_CONNECTION = None
+
+# customers (by id) served by another cluster than TES_DB_URI, e.g.
+# {"64b7f0c2e4b0a1d2c3f4a5b6": {"uri": "mongodb+srv://...", "db": "widget"}}
+# customers are always resolved on TES_DB_URI
+TENANT_CLUSTERS = json.loads(os.environ.get("TES_DB_TENANT_CLUSTERS") or "{}")
+# clients of the tenant clusters by URI, created on first use
+CLUSTER_CONNECTIONS = {}
+ASYNC_CLUSTER_CONNECTIONS = {}
+
+# MongoDB requires maxStalenessSeconds to be at least 90
+DB_MAX_STALENESS_SECONDS = int(
+    os.environ.get("TES_DB_MAX_STALENESS_SECONDS", "90")
+)
 
 
 def get_connection():
+    # the client reconnects on its own, no ping per call
     global DB_CONNECTION
-    if not connection_is_valid():
-        DB_CONNECTION = MongoClient(DB_URI)
+    if DB_CONNECTION is None:
+        DB_CONNECTION = MongoClient(DB_URI, minPoolSize=DB_MIN_POOL_SIZE)
     return DB_CONNECTION
 
 
-def connection_is_valid():
-    if not DB_CONNECTION:
-        return False
-    try:
-        DB_CONNECTION.server_info()
-        return True
-    except Exception:
-        return False
+def get_async_connection():
+    global ASYNC_DB_CONNECTION
+    if ASYNC_DB_CONNECTION is None:
+        ASYNC_DB_CONNECTION = AsyncMongoClient(
+            DB_URI, minPoolSize=DB_MIN_POOL_SIZE
+        )
+    return ASYNC_DB_CONNECTION
+
+
+def get_cluster_connection(uri=None):
+    """Pooled client of the cluster at uri, the default cluster if None."""
+    if not uri or uri == DB_URI:
+        return get_connection()
+    if uri not in CLUSTER_CONNECTIONS:
+        CLUSTER_CONNECTIONS[uri] = MongoClient(
+            uri, minPoolSize=DB_MIN_POOL_SIZE
+        )
+    return CLUSTER_CONNECTIONS[uri]
+
+
+def get_async_cluster_connection(uri=None):
+    if not uri or uri == DB_URI:
+        return get_async_connection()
+    if uri not in ASYNC_CLUSTER_CONNECTIONS:
+        ASYNC_CLUSTER_CONNECTIONS[uri] = AsyncMongoClient(
+            uri, minPoolSize=DB_MIN_POOL_SIZE
+        )
+    return ASYNC_CLUSTER_CONNECTIONS[uri]
+
+
+def get_tenant_database(tenant, default_db=None, read_preference=None):
+    """
+    Database of tenant on its cluster from TENANT_CLUSTERS. Tenants that
+    are not listed use the default cluster and default_db, or their own
+    name as database.
+    """
+    cluster = TENANT_CLUSTERS.get(tenant, {})
+    return get_cluster_connection(cluster.get("uri")).get_database(
+        cluster.get("db", default_db or tenant),
+        read_preference=read_preference,
+    )
+
+
+def get_async_tenant_database(tenant, default_db=None, read_preference=None):
+    cluster = TENANT_CLUSTERS.get(tenant, {})
+    return get_async_cluster_connection(cluster.get("uri")).get_database(
+        cluster.get("db", default_db or tenant),
+        read_preference=read_preference,
+    )
+
+
+def get_tenant_databases(default_db):
+    """The default database and every distinct tenant cluster database."""
+    databases = {(None, default_db)}
+    for cluster in TENANT_CLUSTERS.values():
+        databases.add((cluster.get("uri"), cluster.get("db", default_db)))
+    return [
+        get_cluster_connection(uri)[name]
+        for uri, name in sorted(databases, key=lambda db: (db[0] or "", db[1]))
+    ]
+
+
+def secondary_preferred(max_staleness=DB_MAX_STALENESS_SECONDS):
+    """Read preference for read-only handlers that tolerate stale reads."""
+    return SecondaryPreferred(max_staleness=max_staleness)
@@ -0,0 +1,89 @@
+import contextlib
+import contextvars
+import os
+import time
+import pymongo
+from pymongo.errors import PyMongoError
+
+
+# kept back from the Lambda remaining time to send the response
+DEADLINE_MARGIN_MS = int(os.environ.get("DEADLINE_MARGIN_MS", "500"))
+# requests with less time left are rejected with 503 before any work
+DEADLINE_MIN_MS = int(os.environ.get("DEADLINE_MIN_MS", "1000"))
+# budget of invocations without a Lambda context, e.g. local runs
+DEFAULT_BUDGET_MS = 30 * 1000
+
+# deadline of the running handler, see Deadline.apply
+_CURRENT = contextvars.ContextVar("deadline", default=None)
+
+
+class DeadlineExceeded(Exception):
+    """Raised instead of starting a call once the deadline has run out."""
+
+
+class Deadline:
+    """
+    Time budget of an invocation, the Lambda remaining time minus
+    DEADLINE_MARGIN_MS. Inside apply() MongoDB operations get a maxTimeMS
+    and outbound HTTP calls a timeout from what is left of the budget.
+    """
+
+    def __init__(self, budget_ms):
+        self.expires_at = time.monotonic() + budget_ms / 1000
+
+    @classmethod
+    def from_context(cls, context):
+        get_remaining_time = getattr(
+            context, "get_remaining_time_in_millis", None
+        )
+        remaining_ms = (
+            get_remaining_time() if get_remaining_time else DEFAULT_BUDGET_MS
+        )
+        return cls(remaining_ms - DEADLINE_MARGIN_MS)
+
+    def remaining(self):
+        """Seconds left of the budget."""
+        return max(0.0, self.expires_at - time.monotonic())
+
+    def too_short(self):
+        return self.remaining() * 1000 < DEADLINE_MIN_MS
+
+    def timeout(self, default):
+        """Timeout in seconds for a call that is allowed default seconds."""
+        return min(default, self.remaining())
+
+    @contextlib.contextmanager
+    def apply(self):
+        token = _CURRENT.set(self)
+        try:
+            with pymongo.timeout(self.remaining()):
+                yield self
+        finally:
+            _CURRENT.reset(token)
+
+
+def http_timeout(default):
+    """
+    Timeout for an outbound HTTP call, capped by the running deadline.
+    Raises DeadlineExceeded if no time is left, a timeout of 0 is rejected
+    by the HTTP clients.
+    """
+    deadline = _CURRENT.get()
+    if not deadline:
+        return default
+    if deadline_exceeded():
+        raise DeadlineExceeded()
+    return deadline.timeout(default)
+
+
+def deadline_exceeded():
+    """Whether the deadline of the running handler has no time left."""
+    deadline = _CURRENT.get()
+    return deadline is not None and deadline.remaining() <= 0
+
+
+def is_timeout(error):
+    """Whether error was raised because the deadline was exceeded."""
+    if isinstance(error, DeadlineExceeded):
+        return True
+    return isinstance(error, PyMongoError) and error.timeout
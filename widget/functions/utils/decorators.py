@@ -1,10 +1,34 @@
+import asyncio
+import base64
 import json
 import logging
+import os
+import zlib
 from functools import wraps
 from bson import ObjectId
-from .database_connection import get_connection
+from .database_connection import (
+    get_async_tenant_database,
+    get_tenant_database,
+)
+from .http_connection import get_async_http_client
+from .object_storage import offload_large_response
 from .aws_lambda_proxy import LambdaApi
+from .customers import (
+    find_customer,
+    find_customer_async,
+    warm_customers,
+    warm_customers_async,
+)
 from .response import APIResponse
+from . import admission
+from .deadline import Deadline, is_timeout
+from .profiling import profiling_requested, run_profiled
+from .warmup import (
+    is_provisioned_init,
+    is_warmup,
+    warm_async_connections,
+    warm_connections,
+)
 
 logger = logging.getLogger(__name__)
 
@@ -13,6 +37,23 @@ CORS_HEADERS = {
     "Access-Control-Allow-Headers": "Content-Type,X-Amz-Date,Authorization,X-Api-Key,X-Amz-Security-Token,X-Amz-User-Agent"
 }
 
+DB_NAME = "jeptools__widget"
+
+# Async clients are bound to the loop they were created in, so all
+# api_async invocations of a container share one loop
+EVENT_LOOP = asyncio.new_event_loop()
+
+# decoded request bodies above this size are rejected with 413
+MAX_BODY_BYTES = int(os.environ.get("REQUEST_MAX_BODY_BYTES", "1048576"))
+
+
+class RequestBodyError(Exception):
+    """Raised while parsing a request body that is rejected by response."""
+
+    def __init__(self, response):
+        super().__init__(response[0])
+        self.response = response
+
 
 # Custom JSON encoder to handle MongoDB ObjectId
 class JSONEncoder(json.JSONEncoder):
@@ -22,33 +63,67 @@ class JSONEncoder(json.JSONEncoder):
         return super(JSONEncoder, self).default(obj)
 
 
-def api(handler):
+# Create a mock route entry for use with LambdaApi
+class RouteEntry:
+    def __init__(self, method, cors=True):
+        self.method = method
+        self.cors = cors
+        self.compression = ""
+        self.b64encode = False
+        self.ttl = None
+
+
+def api(handler=None, *, read_preference=None, warmup=None):
     """
     Decorator for AWS Lambda functions with API Gateway integration.
     - Formats responses in correct API Gateway format using LambdaApi
     - Adds CORS headers
     - Includes error handling
     - Returns proxy integration compatible responses
+
+    Can be used as ``@api`` or ``@api(read_preference=...)``. Handlers
+    without a read preference read from the primary, which is required
+    whenever a handler reads its own writes.
+
+    The handler runs under a Deadline derived from the Lambda remaining
+    time, MongoDB operations that would outlast it are aborted and the
+    request is answered with 503. Outbound HTTP calls take their timeout
+    from deadline.http_timeout.
+
+    Requests are authenticated with the api key before admission control,
+    requests without a known customer are answered with 401. The handler
+    gets the customer as request.customer.
+
+    Warm-up invocations (scheduled events) do not run the handler. They
+    open the MongoDB pools of all clusters, load the customers into memory
+    and call ``warmup(db)``. Containers initialized by provisioned
+    concurrency for the handler warm up at import.
     """
+    if handler is None:
+        return lambda handler: api(
+            handler, read_preference=read_preference, warmup=warmup
+        )
 
     # Create LambdaApi instance for response handling
     lambda_api = LambdaApi("api", debug=True)
 
+    def warm_up():
+        warm_connections()
+        warm_customers(get_tenant_database(None, DB_NAME))
+        if warmup:
+            warmup(
+                get_tenant_database(
+                    None, DB_NAME, read_preference=read_preference
+                )
+            )
+
     @wraps(handler)
     def wrapper(event, context):
         logger.debug(f"Event: {event}")
 
-        # Create a mock route entry for use with LambdaApi
-        class RouteEntry:
-            def __init__(self, method, cors=True):
-                self.method = method
-                self.cors = cors
-                self.compression = ""
-                self.b64encode = False
-                self.ttl = None
-
-        # Get database connection
-        db_connection = get_connection()
+        if is_warmup(event):
+            warm_up()
+            return {"warmup": True}
 
         http_method = event.get("httpMethod", "GET")
         headers = event.get("headers", {}) or {}
@@ -66,16 +141,77 @@ def api(handler):
                 headers=headers,
             )
 
+        # Fail fast if the invocation is about to time out anyway
+        deadline = Deadline.from_context(context)
+        if deadline.too_short():
+            return lambda_api.process_response(
+                route_entry=route_entry,
+                response=APIResponse.service_unavailable("deadline exceeded"),
+                headers=headers,
+            )
+
+        # Admission control right after the (usually cached) customer
+        # lookup, keyed on the customer so unknown keys leave no state
+        customer = find_customer(
+            get_tenant_database(None, DB_NAME), get_header(headers, "x-api-key")
+        )
+        if not customer:
+            return lambda_api.process_response(
+                route_entry=route_entry,
+                response=APIResponse.not_authorized(),
+                headers=headers,
+            )
+        tenant = str(customer["_id"])
+        db = get_tenant_database(tenant, DB_NAME)
+        slot, retry_after = admission.admit(db, tenant, context)
+        if not slot:
+            return lambda_api.process_response(
+                route_entry=route_entry,
+                response=APIResponse.too_many_requests(retry_after),
+                headers=headers,
+            )
+        try:
+            return handle_admitted(
+                event, context, customer, deadline, headers, route_entry
+            )
+        finally:
+            admission.release(db, tenant, slot)
+
+    def handle_admitted(
+        event, context, customer, deadline, headers, route_entry
+    ):
         # Create Request object
-        request = Request(event, context, db=db_connection["jeptools__widget"])
+        try:
+            request = Request(
+                event,
+                context,
+                customer=customer,
+                db=get_tenant_database(
+                    str(customer["_id"]),
+                    DB_NAME,
+                    read_preference=read_preference,
+                ),
+                deadline=deadline,
+            )
+        except RequestBodyError as e:
+            return lambda_api.process_response(
+                route_entry=route_entry, response=e.response, headers=headers
+            )
 
         # Execute handler
-        response = handler(request)
+        try:
+            with deadline.apply():
+                response = handler(request)
+        except Exception as e:
+            if not is_timeout(e):
+                raise
+            response = APIResponse.service_unavailable("deadline exceeded")
 
         # Handle tuple response from APIResponse methods
         if isinstance(response, tuple) and len(response) >= 2:
+            response = offload_large_response(response)
             return lambda_api.process_response(
-                route_entry=RouteEntry(method=http_method),
+                route_entry=route_entry,
                 response=response,  # APIResponse already returns properly formatted tuples
                 headers=headers,
             )
@@ -83,17 +219,179 @@ def api(handler):
         # If the handler returned a direct API Gateway response
         return response
 
+    @wraps(handler)
+    def profiled_wrapper(event, context):
+        if profiling_requested(event):
+            return run_profiled(wrapper, lambda_api.log, event, context)
+        return wrapper(event, context)
+
+    if is_provisioned_init(handler):
+        warm_up()
+
+    return profiled_wrapper
+
+
+def api_async(handler=None, *, read_preference=None, warmup=None):
+    """
+    Asyncio variant of the api decorator for coroutine handlers.
+
+    The handler receives an AsyncRequest whose db is backed by the async
+    MongoDB client and which carries a shared async HTTP client, so
+    independent I/O can be awaited concurrently. The warmup coroutine is
+    called with the async db and HTTP client.
+    """
+    if handler is None:
+        return lambda handler: api_async(
+            handler, read_preference=read_preference, warmup=warmup
+        )
+
+    # Create LambdaApi instance for response handling
+    lambda_api = LambdaApi("api", debug=True)
+
+    async def warm_up():
+        await warm_async_connections()
+        await warm_customers_async(get_async_tenant_database(None, DB_NAME))
+        if warmup:
+            await warmup(
+                get_async_tenant_database(
+                    None, DB_NAME, read_preference=read_preference
+                ),
+                get_async_http_client(),
+            )
+
+    async def handle(event, context):
+        logger.debug(f"Event: {event}")
+
+        if is_warmup(event):
+            await warm_up()
+            return {"warmup": True}
+
+        http_method = event.get("httpMethod", "GET")
+        headers = event.get("headers", {}) or {}
+        headers.update(CORS_HEADERS)  # Apply standard CORS headers
+        route_entry = RouteEntry(method=http_method)
+
+        # OPTIONS requests for CORS
+        if http_method == "OPTIONS":
+            return lambda_api.process_response(
+                route_entry=route_entry,
+                response=({}, 200),
+                headers=headers,
+            )
+
+        # Fail fast if the invocation is about to time out anyway
+        deadline = Deadline.from_context(context)
+        if deadline.too_short():
+            return lambda_api.process_response(
+                route_entry=route_entry,
+                response=APIResponse.service_unavailable("deadline exceeded"),
+                headers=headers,
+            )
+
+        # Admission control right after the customer lookup, the limits
+        # are shared with the sync handlers
+        customer = await find_customer_async(
+            get_async_tenant_database(None, DB_NAME),
+            get_header(headers, "x-api-key"),
+        )
+        if not customer:
+            return lambda_api.process_response(
+                route_entry=route_entry,
+                response=APIResponse.not_authorized(),
+                headers=headers,
+            )
+        tenant = str(customer["_id"])
+        db = get_async_tenant_database(tenant, DB_NAME)
+        slot, retry_after = await admission.admit_async(db, tenant, context)
+        if not slot:
+            return lambda_api.process_response(
+                route_entry=route_entry,
+                response=APIResponse.too_many_requests(retry_after),
+                headers=headers,
+            )
+        try:
+            return await handle_admitted(
+                event, context, customer, deadline, headers, route_entry
+            )
+        finally:
+            await admission.release_async(db, tenant, slot)
+
+    async def handle_admitted(
+        event, context, customer, deadline, headers, route_entry
+    ):
+        # Create Request object
+        try:
+            request = AsyncRequest(
+                event,
+                context,
+                customer=customer,
+                db=get_async_tenant_database(
+                    str(customer["_id"]),
+                    DB_NAME,
+                    read_preference=read_preference,
+                ),
+                http=get_async_http_client(),
+                deadline=deadline,
+            )
+        except RequestBodyError as e:
+            return lambda_api.process_response(
+                route_entry=route_entry, response=e.response, headers=headers
+            )
+
+        # Execute handler
+        try:
+            with deadline.apply():
+                response = await handler(request)
+        except Exception as e:
+            if not is_timeout(e):
+                raise
+            response = APIResponse.service_unavailable("deadline exceeded")
+
+        # Handle tuple response from APIResponse methods
+        if isinstance(response, tuple) and len(response) >= 2:
+            response = offload_large_response(response)
+            return lambda_api.process_response(
+                route_entry=route_entry,
+                response=response,
+                headers=headers,
+            )
+
+        # If the handler returned a direct API Gateway response
+        return response
+
+    @wraps(handler)
+    def wrapper(event, context):
+        if profiling_requested(event):
+            return run_profiled(
+                EVENT_LOOP.run_until_complete,
+                lambda_api.log,
+                handle(event, context),
+            )
+        return EVENT_LOOP.run_until_complete(handle(event, context))
+
+    if is_provisioned_init(handler):
+        EVENT_LOOP.run_until_complete(warm_up())
+
     return wrapper
 
 
+def get_header(headers, name):
+    """Case insensitive header lookup."""
+    for key, value in headers.items():
+        if key.lower() == name:
+            return value
+    return None
+
+
 class Request:
     """Encapsulation of Lambda event and context data."""
 
-    def __init__(self, event, context, customer=None, db=None):
+    def __init__(self, event, context, customer=None, db=None, deadline=None):
         self.event = event
         self.context = context
         self.customer = customer
         self.db = db
+        self.deadline = deadline
         self.method = event.get("httpMethod")
         self.pathParameters = event.get("pathParameters", {}) or {}
         self.queryStringParameters = (
@@ -102,11 +400,59 @@ class Request:
         self.body = self._parse_body(event.get("body"))
 
     def _parse_body(self, body):
-        """Parse request body as JSON."""
+        """
+        Parse request body as JSON, decoding base64 encoded and gzip
+        compressed bodies. Raises RequestBodyError for bodies above
+        MAX_BODY_BYTES (checked before decoding) and malformed bodies.
+        """
         if not body:
             return {}
+
+        headers = {
+            key.lower(): value
+            for key, value in (self.event.get("headers") or {}).items()
+        }
+        is_base64 = self.event.get("isBase64Encoded", False)
+        if is_base64:
+            # 4 base64 characters encode 3 bytes
+            size = len(body) // 4 * 3
+        elif isinstance(body, str):
+            size = len(body.encode())
+        else:
+            size = len(body)
+        if size > MAX_BODY_BYTES:
+            raise RequestBodyError(APIResponse.payload_too_large())
+
         try:
+            if is_base64:
+                body = base64.b64decode(body, validate=True)
+            if headers.get("content-encoding", "").lower() == "gzip":
+                body = self._decompress(body)
             return json.loads(body)
+        except RequestBodyError:
+            raise
         except Exception as e:
             logger.error(f"Error parsing JSON body: {str(e)}")
-            return {}
+            raise RequestBodyError(APIResponse.bad_request("malformed body"))
+
+    def _decompress(self, body):
+        """Decompress a gzip body, stopping once MAX_BODY_BYTES is exceeded."""
+        if isinstance(body, str):
+            body = body.encode("latin-1")
+        decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
+        data = decompressor.decompress(body, MAX_BODY_BYTES + 1)
+        if len(data) > MAX_BODY_BYTES:
+            raise RequestBodyError(APIResponse.payload_too_large())
+        return data
+
+
+class AsyncRequest(Request):
+    """Request for api_async handlers with an async HTTP client."""
+
+    def __init__(
+        self, event, context, customer=None, db=None, http=None, deadline=None
+    ):
+        super().__init__(
+            event, context, customer=customer, db=db, deadline=deadline
+        )
+        self.http = http
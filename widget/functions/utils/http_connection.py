@@ -0,0 +1,25 @@
+import httpx
+import requests
+
+
+# timeout of outbound calls, capped by the deadline of the request
+HTTP_TIMEOUT_SECONDS = 10.0
+HTTP_TIMEOUT = httpx.Timeout(HTTP_TIMEOUT_SECONDS, connect=5.0)
+# created lazily inside the event loop of the api_async decorator
+ASYNC_HTTP_CLIENT = None
+# keep-alive session of the sync handlers and jobs
+HTTP_SESSION = None
+
+
+def get_async_http_client():
+    global ASYNC_HTTP_CLIENT
+    if ASYNC_HTTP_CLIENT is None or ASYNC_HTTP_CLIENT.is_closed:
+        ASYNC_HTTP_CLIENT = httpx.AsyncClient(timeout=HTTP_TIMEOUT)
+    return ASYNC_HTTP_CLIENT
+
+
+def get_http_session():
+    global HTTP_SESSION
+    if HTTP_SESSION is None:
+        HTTP_SESSION = requests.Session()
+    return HTTP_SESSION
@@ -0,0 +1,81 @@
+import hashlib
+import mimetypes
+import os
+import boto3
+from botocore.exceptions import ClientError
+
+
+# binary responses above this size are served from object storage
+OFFLOAD_BUCKET = os.environ.get("OFFLOAD_BUCKET")
+OFFLOAD_THRESHOLD_BYTES = int(
+    os.environ.get("OFFLOAD_THRESHOLD_BYTES", str(512 * 1024))
+)
+# stable public base url (e.g. CloudFront), presigned urls are used if unset
+OFFLOAD_PUBLIC_URL = os.environ.get("OFFLOAD_PUBLIC_URL")
+OFFLOAD_URL_EXPIRES = int(os.environ.get("OFFLOAD_URL_EXPIRES", "3600"))
+# set to a local S3 compatible endpoint (e.g. MinIO) for testing
+S3_ENDPOINT_URL = os.environ.get("S3_ENDPOINT_URL")
+
+S3_CLIENT = None
+# keys this container stored or found in the bucket, they are not checked
+# again
+_STORED_KEYS = set()
+
+
+def get_s3_client():
+    global S3_CLIENT
+    if S3_CLIENT is None:
+        S3_CLIENT = boto3.client("s3", endpoint_url=S3_ENDPOINT_URL)
+    return S3_CLIENT
+
+
+def store_object(body, content_type):
+    """
+    Store body under a content addressed key, so every payload is uploaded
+    only once, and return the url it can be fetched from. The HEAD check
+    needs s3:ListBucket, without it missing keys answer 403 instead of 404.
+    """
+    extension = mimetypes.guess_extension(content_type) or ""
+    key = f"responses/{hashlib.sha256(body).hexdigest()}{extension}"
+
+    s3 = get_s3_client()
+    if key not in _STORED_KEYS:
+        try:
+            s3.head_object(Bucket=OFFLOAD_BUCKET, Key=key)
+        except ClientError as e:
+            if e.response["Error"]["Code"] not in ("404", "NoSuchKey"):
+                raise
+            s3.put_object(
+                Bucket=OFFLOAD_BUCKET,
+                Key=key,
+                Body=body,
+                ContentType=content_type,
+                CacheControl="public, max-age=31536000, immutable",
+            )
+        _STORED_KEYS.add(key)
+
+    if OFFLOAD_PUBLIC_URL:
+        return f"{OFFLOAD_PUBLIC_URL.rstrip('/')}/{key}"
+    return s3.generate_presigned_url(
+        "get_object",
+        Params={"Bucket": OFFLOAD_BUCKET, "Key": key},
+        ExpiresIn=OFFLOAD_URL_EXPIRES,
+    )
+
+
+def offload_large_response(response):
+    """
+    Replace a large binary handler response tuple by a redirect to the
+    body stored in object storage.
+    """
+    if not OFFLOAD_BUCKET or len(response) < 5 or not response[4]:
+        return response
+    body, status, content_type = response[0], response[1], response[2]
+    if status != 200 or len(body) < OFFLOAD_THRESHOLD_BYTES:
+        return response
+
+    url = store_object(body, content_type)
+
+    # presigned urls expire, so only stable redirects keep the cache headers
+    headers = response[5] if len(response) > 5 and OFFLOAD_PUBLIC_URL else None
+    return ("", 302, "text/plain", url, False, headers)
@@ -0,0 +1,268 @@
+import time
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+
+class TokenBucket:
+    """
+    Token bucket shared by all containers, stored in one MongoDB document.
+
+    Refill and take happen in a single atomic pipeline update using the
+    server clock, so concurrent Lambdas never over-spend the bucket.
+    """
+
+    def __init__(self, collection, key, rate, capacity):
+        self.collection = collection
+        self.key = key
+        self.rate = rate
+        self.capacity = capacity
+
+    def _update(self, tokens):
+        elapsed_ms = {
+            "$subtract": ["$$NOW", {"$ifNull": ["$updated_at", "$$NOW"]}]
+        }
+        refilled = {
+            "$min": [
+                self.capacity,
+                {
+                    "$add": [
+                        {"$ifNull": ["$tokens", self.capacity]},
+                        {"$multiply": [elapsed_ms, self.rate / 1000]},
+                    ]
+                },
+            ]
+        }
+        return [
+            {"$set": {"tokens": refilled, "updated_at": "$$NOW"}},
+            {"$set": {"allowed": {"$gte": ["$tokens", tokens]}}},
+            {
+                "$set": {
+                    "tokens": {
+                        "$cond": [
+                            "$allowed",
+                            {"$subtract": ["$tokens", tokens]},
+                            "$tokens",
+                        ]
+                    }
+                }
+            },
+        ]
+
+    def acquire(self, tokens=1):
+        """Take tokens, returns False if the bucket has not enough left."""
+        bucket = self.collection.find_one_and_update(
+            {"_id": self.key},
+            self._update(tokens),
+            upsert=True,
+            return_document=ReturnDocument.AFTER,
+        )
+        return bucket["allowed"]
+
+    async def acquire_async(self, tokens=1):
+        bucket = await self.collection.find_one_and_update(
+            {"_id": self.key},
+            self._update(tokens),
+            upsert=True,
+            return_document=ReturnDocument.AFTER,
+        )
+        return bucket["allowed"]
+
+
+class LeasedTokenBucket:
+    """
+    In-process fast path in front of a shared TokenBucket. Tokens are
+    leased from the shared bucket lease_size at a time and spent locally,
+    so most requests do not touch MongoDB. Leased tokens expire after
+    lease_seconds, idle containers do not hoard capacity.
+    """
+
+    def __init__(self, bucket, lease_size, lease_seconds=1):
+        self.bucket = bucket
+        self.lease_size = lease_size
+        self.lease_seconds = lease_seconds
+        self.tokens = 0
+        self.expires_at = 0
+
+    def acquire(self):
+        if self.tokens > 0 and time.monotonic() < self.expires_at:
+            self.tokens -= 1
+            return True
+
+        if self.lease_size > 1 and self.bucket.acquire(self.lease_size):
+            self.tokens = self.lease_size - 1
+        elif self.bucket.acquire():
+            self.tokens = 0
+        else:
+            return False
+        self.expires_at = time.monotonic() + self.lease_seconds
+        return True
+
+    async def acquire_async(self):
+        if self.tokens > 0 and time.monotonic() < self.expires_at:
+            self.tokens -= 1
+            return True
+
+        if self.lease_size > 1 and await self.bucket.acquire_async(
+            self.lease_size
+        ):
+            self.tokens = self.lease_size - 1
+        elif await self.bucket.acquire_async():
+            self.tokens = 0
+        else:
+            return False
+        self.expires_at = time.monotonic() + self.lease_seconds
+        return True
+
+
+class ConcurrencyLimiter:
+    """
+    Caps concurrent requests across all containers. Every running request
+    holds a slot in one MongoDB document. Slots expire on their own, so
+    requests killed by a timeout do not leak capacity.
+    """
+
+    def __init__(self, collection, key, max_concurrency):
+        self.collection = collection
+        self.key = key
+        self.max_concurrency = max_concurrency
+
+    def _acquire_update(self, slot_id, timeout_ms):
+        live_slots = {
+            "$filter": {
+                "input": {"$ifNull": ["$slots", []]},
+                "cond": {"$gt": ["$$this.expires_at", "$$NOW"]},
+            }
+        }
+        new_slot = {
+            "id": slot_id,
+            "expires_at": {"$add": ["$$NOW", timeout_ms]},
+        }
+        return [
+            {"$set": {"slots": live_slots}},
+            {
+                "$set": {
+                    "slots": {
+                        "$cond": [
+                            {
+                                "$lt": [
+                                    {"$size": "$slots"},
+                                    self.max_concurrency,
+                                ]
+                            },
+                            {"$concatArrays": ["$slots", [new_slot]]},
+                            "$slots",
+                        ]
+                    }
+                }
+            },
+        ]
+
+    def acquire(self, slot_id, timeout_ms):
+        """Take a slot held for at most timeout_ms, False if all are taken."""
+        try:
+            limiter = self.collection.find_one_and_update(
+                {"_id": self.key},
+                self._acquire_update(slot_id, timeout_ms),
+                projection={"slots.id": 1},
+                upsert=True,
+                return_document=ReturnDocument.AFTER,
+            )
+        except DuplicateKeyError:
+            # concurrent upsert of the first slot, the retry updates
+            return self.acquire(slot_id, timeout_ms)
+        return any(slot["id"] == slot_id for slot in limiter["slots"])
+
+    async def acquire_async(self, slot_id, timeout_ms):
+        try:
+            limiter = await self.collection.find_one_and_update(
+                {"_id": self.key},
+                self._acquire_update(slot_id, timeout_ms),
+                projection={"slots.id": 1},
+                upsert=True,
+                return_document=ReturnDocument.AFTER,
+            )
+        except DuplicateKeyError:
+            return await self.acquire_async(slot_id, timeout_ms)
+        return any(slot["id"] == slot_id for slot in limiter["slots"])
+
+    def release(self, slot_id):
+        self.collection.update_one(
+            {"_id": self.key}, {"$pull": {"slots": {"id": slot_id}}}
+        )
+
+    async def release_async(self, slot_id):
+        await self.collection.update_one(
+            {"_id": self.key}, {"$pull": {"slots": {"id": slot_id}}}
+        )
+
+
+class CircuitBreaker:
+    """
+    Circuit breaker shared by all containers, stored in one MongoDB document.
+
+    After failure_threshold consecutive failures the breaker opens for
+    reset_seconds. Once that passed calls are let through again, a single
+    failure re-opens it and a success closes it.
+    """
+
+    def __init__(self, collection, key, failure_threshold, reset_seconds):
+        self.collection = collection
+        self.key = key
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+
+    def _failure_update(self):
+        failures = {"$add": [{"$ifNull": ["$failures", 0]}, 1]}
+        return [
+            {"$set": {"failures": failures}},
+            {
+                "$set": {
+                    "opened_until": {
+                        "$cond": [
+                            {"$gte": ["$failures", self.failure_threshold]},
+                            {
+                                "$add": [
+                                    "$$NOW",
+                                    self.reset_seconds * 1000,
+                                ]
+                            },
+                            "$opened_until",
+                        ]
+                    }
+                }
+            },
+        ]
+
+    def _open_query(self):
+        return {"_id": self.key, "$expr": {"$gt": ["$opened_until", "$$NOW"]}}
+
+    def is_open(self):
+        return (
+            self.collection.find_one(self._open_query(), {"_id": 1}) is not None
+        )
+
+    async def is_open_async(self):
+        breaker = await self.collection.find_one(self._open_query(), {"_id": 1})
+        return breaker is not None
+
+    def record_success(self):
+        self.collection.update_one(
+            {"_id": self.key, "failures": {"$gt": 0}},
+            {"$set": {"failures": 0, "opened_until": None}},
+        )
+
+    async def record_success_async(self):
+        await self.collection.update_one(
+            {"_id": self.key, "failures": {"$gt": 0}},
+            {"$set": {"failures": 0, "opened_until": None}},
+        )
+
+    def record_failure(self):
+        self.collection.update_one(
+            {"_id": self.key}, self._failure_update(), upsert=True
+        )
+
+    async def record_failure_async(self):
+        await self.collection.update_one(
+            {"_id": self.key}, self._failure_update(), upsert=True
+        )